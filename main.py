@@ -1,13 +1,20 @@
 import glob
 import json
 from sql_rep.query import *
+from sql_rep.backends import get_backend
 import argparse
 import re
+import os
+import subprocess
+import sys
+import time
 
 def read_flags():
     parser = argparse.ArgumentParser()
     parser.add_argument("--db_name", type=str, required=False,
             default="imdb")
+    # comma separated lists of hosts / ports spread the path queries over
+    # several replicas of the same database
     parser.add_argument("--db_host", type=str, required=False,
             default="localhost")
     parser.add_argument("--user", type=str, required=False,
@@ -16,25 +23,459 @@ def read_flags():
             default="")
     parser.add_argument("--port", type=str, required=False,
             default=5432)
+    parser.add_argument("--compute_ground_truth", type=int, required=False,
+            default=0, help="label the subsets of every query on the backend; "
+            "otherwise only parse them")
+    parser.add_argument("--max_inflight", type=int, required=False,
+            default=1, help="concurrent queries per database endpoint")
+    parser.add_argument("--materialize", type=int, required=False,
+            default=0, help="run the paths over temp tables of the filtered "
+            "base relations")
+    parser.add_argument("--backend", type=str, required=False,
+            default="postgres", choices=["postgres", "duckdb", "sqlite"])
+    # for the local backends
+    parser.add_argument("--local_db", type=str, required=False,
+            default=":memory:")
+    parser.add_argument("--data_dir", type=str, required=False,
+            default=None, help="directory of <table>.csv files to load")
+    parser.add_argument("--planner", type=str, required=False,
+            default="path", choices=["path", "bushy"])
+    parser.add_argument("--compare_planners", type=int, required=False,
+            default=0, help="count the queries of the path and bushy "
+            "planners over test_sqls, and exit")
+    parser.add_argument("--known_fraction", type=float, required=False,
+            default=0.0, help="for --compare_planners, the fraction of "
+            "subsets (picked at random) taken as already cached")
+    # work queue mode, see sql_rep/workqueue.py
+    parser.add_argument("--queue", type=str, required=False,
+            default=None, help="sqlite file of the work queue")
+    parser.add_argument("--queue_cmd", type=str, required=False,
+            default="progress", choices=["enqueue", "work", "progress",
+                "assemble", "retry"])
+    parser.add_argument("--lease_seconds", type=float, required=False,
+            default=3600)
+    parser.add_argument("--batch_size", type=int, required=False,
+            default=8, help="tasks a worker claims at a time")
+    parser.add_argument("--poll", type=float, required=False,
+            default=0, help="seconds a worker waits for new tasks, 0 to exit "
+            "when the queue is empty")
+    parser.add_argument("--out_dir", type=str, required=False,
+            default="./parsed/")
+    parser.add_argument("--serve_lookup", type=str, required=False,
+            default=None, help="serve the subset cache's cardinalities on "
+            "unix:<socket path> or http:<host>:<port>")
+    parser.add_argument("--bench_lookup", type=int, required=False,
+            default=0, help="time lookups into the subset cache, and exit")
+    parser.add_argument("--constraints", type=str, required=False,
+            default=None, help="catalog, or a JSON schema file of key "
+            "constraints; subsets that follow from them are not executed")
+    parser.add_argument("--verify_derived", type=int, required=False,
+            default=0, help="derived subsets per query to count directly")
+    parser.add_argument("--dump_constraints", type=str, required=False,
+            default=None, help="write the catalog's key constraints to this "
+            "JSON schema file, and exit")
+    parser.add_argument("--analytics", type=str, required=False,
+            default=None, help="directory of parse_sql json outputs, or "
+            "cache for the subset cache: summarize the estimation errors, "
+            "and exit")
+    # only label some of the subsets, see compute_subsets
+    parser.add_argument("--max_subset_size", type=int, required=False,
+            default=None)
+    parser.add_argument("--subset_contains", type=str, required=False,
+            default=None, help="comma separated aliases every labeled "
+            "subset contains")
+    parser.add_argument("--multi_variant", type=int, required=False,
+            default=0, help="label the test_sqls with the same join topology "
+            "together, one count per subset for all of them, and exit")
+    parser.add_argument("--analytics_out", type=str, required=False,
+            default="./analytics/", help="where --analytics writes its csvs")
+    parser.add_argument("--subset_cache_dir", type=str, required=False,
+            default="./subset_cache/")
+    parser.add_argument("--cache_max_mb", type=float, required=False,
+            default=0, help="size cap of the subset cache, 0 for no cap")
+    parser.add_argument("--eviction", type=str, required=False,
+            default="lru", choices=["lru", "cost"])
+    parser.add_argument("--cache_stats", type=int, required=False,
+            default=0, help="print subset cache stats, and exit")
+    parser.add_argument("--compact_cache", type=int, required=False,
+            default=0, help="compact the subset cache (and evict down to "
+            "--cache_max_mb), and exit")
+    parser.add_argument("--check_compiled", type=int, required=False,
+            default=0, help="check the compiled subset / path sql against "
+            "nx_graph_to_query / nodes_to_sql over test_sqls, and exit")
+    parser.add_argument("--check_parser", type=int, required=False,
+            default=0, help="compare the fast parser's join graphs to the "
+            "sqlparse ones over test_sqls, and exit")
+    parser.add_argument("--bench_import", type=int, required=False,
+            default=0, help="time a cold import of sql_rep.query, and exit")
+    parser.add_argument("--import_budget", type=float, required=False,
+            default=0.5, help="seconds allowed for --bench_import")
     return parser.parse_args()
 
+# none of these should be loaded by just importing the parsing code
+LAZY_MODULES = ["psycopg2", "sqlparse", "moz_sql_parser", "progressbar",
+                "shelve", "pdb", "pygraphviz", "duckdb", "sqlite3",
+                "concurrent.futures"]
 
+IMPORT_BENCH_CODE = """
+import sys, time, json
+start = time.perf_counter()
+import sql_rep.query
+took = time.perf_counter() - start
+print(json.dumps([took, [m for m in {} if m in sys.modules]]))
+"""
+
+def bench_import(budget, num_runs=5):
+    '''
+    imports sql_rep.query in fresh interpreters, and checks the best time is
+    within budget seconds, and that no lazily loaded dependency got imported.
+    '''
+    times = []
+    for _ in range(num_runs):
+        out = subprocess.check_output([sys.executable, "-c",
+            IMPORT_BENCH_CODE.format(LAZY_MODULES)],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        took, loaded = json.loads(out.decode("utf-8").strip().split("\n")[-1])
+        times.append(took)
+
+    best = min(times)
+    print("import sql_rep.query: best {:.3f}s, median {:.3f}s (budget {:.3f}s)"
+            .format(best, sorted(times)[len(times)//2], budget))
+    ok = True
+    if best > budget:
+        print("over the import budget!")
+        ok = False
+    if len(loaded) > 0:
+        print("should be lazily imported, but were loaded:", loaded)
+        ok = False
+    return ok
+
+def check_parser(fns):
+    from sql_rep.fast_parser import check_parity, parse_conjunctive, \
+            UnsupportedQuery
+    fast_time = 0.0
+    slow_time = 0.0
+    num_failed = 0
+    for fn in fns:
+        with open(fn, "r") as f:
+            sql = f.read()
+        try:
+            parse_conjunctive(sql)
+        except UnsupportedQuery as e:
+            print(fn, "falls back to sqlparse:", e)
+
+        start = time.time()
+        fast_graph = extract_join_graph(sql)
+        fast_time += time.time() - start
+        start = time.time()
+        slow_graph = extract_join_graph(sql, fast=False)
+        slow_time += time.time() - start
+
+        diffs = check_parity(sql, fast_graph, slow_graph)
+        if len(diffs) > 0:
+            num_failed += 1
+            print(fn, "differs:")
+            for diff in diffs:
+                print("\t", diff)
+
+    print("{}/{} queries differ. fast parser: {:.3f}s, sqlparse: {:.3f}s"
+            .format(num_failed, len(fns), fast_time, slow_time))
+    return num_failed == 0
+
+def check_compiled(fns):
+    '''
+    checks that CompiledQuery gives the same sql as nx_graph_to_query for
+    every subset, and as nodes_to_sql for every join order of the path cover,
+    and times both.
+    '''
+    from sql_rep.planner import path_cover
+    old_time = 0.0
+    new_time = 0.0
+    num_sqls = 0
+    num_failed = 0
+    for fn in fns:
+        with open(fn, "r") as f:
+            join_graph = extract_join_graph(f.read())
+        subset_graph = generate_subset_graph(join_graph)
+        # a first element of several relations would need postgres to order
+        # it, both ways
+        join_orders = [[(a,) for a in connected_order(join_graph, jo[0])] +
+                jo[1:] for jo in path_cover(subset_graph)]
+
+        start = time.time()
+        old = [nx_graph_to_query(join_graph.subgraph(node))
+                for node in subset_graph.nodes]
+        old += [nodes_to_sql(jo, join_graph) for jo in join_orders]
+        old_time += time.time() - start
+
+        start = time.time()
+        compiled = CompiledQuery(join_graph)
+        new = [compiled.subset_sql(compiled.mask(node))
+                for node in subset_graph.nodes]
+        new += [compiled.path_sql(jo) for jo in join_orders]
+        new_time += time.time() - start
+
+        num_sqls += len(old)
+        diffs = [(o, n) for o, n in zip(old, new) if o != n]
+        if len(diffs) > 0:
+            num_failed += 1
+            print(fn, "differs:")
+            print("\t", diffs[0][0])
+            print("\t", diffs[0][1])
+
+    print("{}/{} queries differ, over {} sqls. nx_graph_to_query / "
+          "nodes_to_sql: {:.3f}s, compiled: {:.3f}s".format(num_failed,
+              len(fns), num_sqls, old_time, new_time))
+    return num_failed == 0
+
+def compare_planners(fns, known_fraction=0.0):
+    '''
+    prints the number of queries the path cover and the bushy cover need to
+    label the unknown subsets of every query, and a lower bound: a tree over
+    n relations has at most n // k disjoint nodes of size k.
+    '''
+    import random
+    from sql_rep.planner import path_cover, bushy_cover
+    random.seed(1234)
+    total_path = 0
+    total_bushy = 0
+    for fn in sorted(fns):
+        with open(fn, "r") as f:
+            sql = f.read()
+        join_graph = extract_join_graph(sql)
+        subset_graph = generate_subset_graph(join_graph)
+        unknown = subset_graph.subgraph([n for n in subset_graph.nodes
+            if random.random() >= known_fraction])
+        if len(unknown) == 0:
+            continue
+
+        num_path = len(path_cover(unknown))
+        trees = bushy_cover(join_graph, unknown)
+        covered = set(s for tree in trees for s in tree_subsets(tree))
+        assert set(unknown.nodes) <= covered
+
+        sizes = {}
+        for node in unknown.nodes:
+            sizes[len(node)] = sizes.get(len(node), 0) + 1
+        bound = max(-(-num // (len(join_graph) // size))
+                for size, num in sizes.items())
+        print("{}: {} subsets, path: {}, bushy: {}, lower bound: {}".format(
+            os.path.basename(fn), len(unknown), num_path, len(trees), bound))
+        total_path += num_path
+        total_bushy += len(trees)
+
+    print("path: {} queries, bushy: {} queries, saved {} ({:.1f}%)".format(
+        total_path, total_bushy, total_path - total_bushy,
+        100.0*(total_path - total_bushy) / max(total_path, 1)))
+
+def bench_lookup(cache_dir, num_lookups=1000000):
+    '''
+    times single and batched lookups of random known subsets, in process.
+    '''
+    import random
+    from sql_rep.lookup import CardinalityIndex
+    start = time.time()
+    index = CardinalityIndex(cache_dir)
+    print("indexed", len(index.fingerprints()), "queries in {:.2f}s".format(
+        time.time() - start))
+    # the entries with a mask layout
+    fingerprints = [fp for fp in index.fingerprints()
+            if index.aliases(fp) is not None]
+    if len(fingerprints) == 0:
+        return
+
+    requests = []
+    for _ in range(num_lookups):
+        fingerprint = random.choice(fingerprints)
+        aliases = index.aliases(fingerprint)
+        subset = random.sample(aliases, random.randint(1, len(aliases)))
+        requests.append((fingerprint, subset))
+
+    start = time.perf_counter()
+    found = sum(1 for fp, subset in requests
+            if index.lookup(fp, subset) is not None)
+    took = time.perf_counter() - start
+    print("single: {:.2f}us per lookup ({} of {} known)".format(
+        took / num_lookups * 1e6, found, num_lookups))
+
+    fingerprint = fingerprints[0]
+    masks = [random.randrange(1, 1 << len(index.aliases(fingerprint)))
+            for _ in range(num_lookups)]
+    start = time.perf_counter()
+    index.lookup_many(fingerprint, masks=masks)
+    took = time.perf_counter() - start
+    print("batched masks: {:.3f}us per lookup".format(
+        took / num_lookups * 1e6))
 
 q_num = re.compile(".*/([0-9]+[a-z])\\.sql.*")
 
 args = read_flags()
 # simple testing script
 fns = list(glob.glob("./test_sqls/*"))
+if args.cache_stats or args.compact_cache:
+    from sql_rep.subset_cache import cache_stats, compact_cache, evict_cache
+    if args.compact_cache:
+        if args.cache_max_mb > 0:
+            evicted = evict_cache(args.subset_cache_dir,
+                    int(args.cache_max_mb*1e6), policy=args.eviction)
+            print("evicted", len(evicted), "entries")
+        before, after = compact_cache(args.subset_cache_dir)
+        print("compacted subset cache from {:.2f}MB to {:.2f}MB".format(
+            before/1e6, after/1e6))
+    print(cache_stats(args.subset_cache_dir))
+    sys.exit(0)
+if args.analytics is not None:
+    from sql_rep.analytics import load_outputs, load_cache, summarize, \
+            export_csv
+    start = time.time()
+    if args.analytics == "cache":
+        data = load_cache(args.subset_cache_dir)
+    else:
+        data = load_outputs(glob.glob(os.path.join(args.analytics, "*.json")))
+    summary = summarize(data)
+    export_csv(summary, args.analytics_out)
+    for name in ["overall", "by_size"]:
+        columns, rows = summary[name]
+        print(name)
+        print("\t".join(columns))
+        for row in rows:
+            print("\t".join("{:.2f}".format(v) if isinstance(v, float)
+                else str(v) for v in row))
+    print("{} subsets of {} queries, took {:.2f}s; tables in {}".format(
+        len(data["actual"]), len(data["queries"]), time.time() - start,
+        args.analytics_out))
+    sys.exit(0)
+if args.bench_lookup:
+    bench_lookup(args.subset_cache_dir)
+    sys.exit(0)
+if args.serve_lookup is not None:
+    from sql_rep.lookup import CardinalityIndex, serve_unix, serve_http
+    index = CardinalityIndex(args.subset_cache_dir)
+    kind, address = args.serve_lookup.split(":", 1)
+    if kind == "unix":
+        serve_unix(index, address)
+    else:
+        host, port = address.rsplit(":", 1)
+        serve_http(index, host, int(port))
+    sys.exit(0)
+if args.bench_import:
+    ok = bench_import(args.import_budget)
+    sys.exit(0 if ok else 1)
+if args.check_parser:
+    ok = check_parser([fn for fn in fns if ".sql" in fn])
+    sys.exit(0 if ok else 1)
+if args.check_compiled:
+    ok = check_compiled([fn for fn in fns if ".sql" in fn])
+    sys.exit(0 if ok else 1)
+if args.compare_planners:
+    compare_planners([fn for fn in fns if ".sql" in fn],
+            known_fraction=args.known_fraction)
+    sys.exit(0)
+
+if args.backend == "postgres":
+    # one backend (and replica pool) for the whole run, so the latencies and
+    # benched replicas carry over from query to query
+    backend = get_backend("postgres", user=args.user, db_host=args.db_host,
+            port=args.port, pwd=args.pwd, db_name=args.db_name,
+            max_inflight=args.max_inflight, materialize=args.materialize)
+else:
+    backend = get_backend(args.backend, database=args.local_db,
+                          data_dir=args.data_dir,
+                          materialize=args.materialize)
+
+max_bytes = int(args.cache_max_mb*1e6) if args.cache_max_mb > 0 else None
+
+if args.queue is not None:
+    from sql_rep import workqueue
+    sql_fns = sorted(fn for fn in fns if ".sql" in fn)
+    if args.queue_cmd == "enqueue":
+        sqls = []
+        for fn in sql_fns:
+            with open(fn, "r") as f:
+                sqls.append(f.read())
+        names = [q_num.match(fn).group(1) for fn in sql_fns]
+        num_tasks = workqueue.enqueue(args.queue, sqls, names,
+                subset_cache_dir=args.subset_cache_dir, planner=args.planner)
+        print("enqueued", num_tasks, "tasks")
+    elif args.queue_cmd == "work":
+        workqueue.work(args.queue, backend, lease_seconds=args.lease_seconds,
+                batch_size=args.batch_size, poll=args.poll,
+                subset_cache_max_bytes=max_bytes, eviction=args.eviction)
+    elif args.queue_cmd == "retry":
+        print("requeued", workqueue.retry_failed(args.queue), "failed tasks")
+    elif args.queue_cmd == "assemble":
+        incomplete = workqueue.assemble(args.queue, args.out_dir)
+        print(len(incomplete), "queries not done yet:", incomplete)
+    print(json.dumps(workqueue.progress(args.queue)["tasks"]))
+    sys.exit(0)
+if args.multi_variant:
+    from sql_rep.variants import group_variants, label_variants
+    sql_fns = sorted(fn for fn in fns if ".sql" in fn)
+    sqls = []
+    for fn in sql_fns:
+        with open(fn, "r") as f:
+            sqls.append(f.read())
+    groups = [g for g in group_variants(sqls) if len(g) > 1]
+    num_counts = 0
+    num_paths = 0
+    for group in groups:
+        print("Processing", [q_num.match(sql_fns[i]).group(1) for i in group])
+        for i in group:
+            join_graph = extract_join_graph(sqls[i])
+            fingerprint = query_fingerprint(join_graph)
+            subset_graph = generate_subset_graph(join_graph)
+            stored = load_subsets(args.subset_cache_dir,
+                    get_subset_cache_name(fingerprint), fingerprint,
+                    track=False)
+            num_paths += len(path_cover(subset_graph.subgraph(
+                subset_graph.nodes - stored.keys())))
+        num_counts += label_variants([sqls[i] for i in group], backend,
+                subset_cache_dir=args.subset_cache_dir,
+                subset_cache_max_bytes=max_bytes, eviction=args.eviction)
+    print("{} queries in {} groups: {} count queries, instead of {} path "
+          "queries".format(sum(len(g) for g in groups), len(groups),
+              num_counts, num_paths))
+    sys.exit(0)
+
+constraints = None
+if args.constraints is not None or args.dump_constraints is not None:
+    from sql_rep.constraints import KeyConstraints
+    if args.constraints is None or args.constraints == "catalog":
+        constraints = KeyConstraints.from_catalog(backend)
+    else:
+        constraints = KeyConstraints.from_file(args.constraints)
+    if args.dump_constraints is not None:
+        constraints.to_file(args.dump_constraints)
+        sys.exit(0)
 for fn in fns:
     if ".sql" in fn:
         sql_id = q_num.match(fn).group(1)
         with open(fn, "r") as f:
             sql = f.read()
         print("Processing", sql_id)
+        if args.max_subset_size is not None or \
+                args.subset_contains is not None:
+            contains = None
+            if args.subset_contains is not None:
+                contains = args.subset_contains.split(",")
+            cards = compute_subsets(sql, backend,
+                    max_size=args.max_subset_size, contains=contains,
+                    subset_cache_dir=args.subset_cache_dir,
+                    subset_cache_max_bytes=max_bytes, eviction=args.eviction)
+            print(len(cards), "subsets labeled")
+            continue
         sql_json = parse_sql(sql, args.user, args.db_name,
                              args.db_host, args.port, args.pwd,
-                             compute_ground_truth=False)
-        print(sql_json.keys())
-        break
-        with open(f"parsed/{sql_id}.json", "w") as f:
+                             compute_ground_truth=args.compute_ground_truth,
+                             max_inflight=args.max_inflight,
+                             backend=backend,
+                             materialize=args.materialize,
+                             subset_cache_dir=args.subset_cache_dir,
+                             subset_cache_max_bytes=max_bytes,
+                             eviction=args.eviction,
+                             planner=args.planner,
+                             constraints=constraints,
+                             verify_derived=args.verify_derived)
+        make_dir(args.out_dir)
+        with open(os.path.join(args.out_dir, sql_id + ".json"), "w") as f:
             json.dump(sql_json, f)
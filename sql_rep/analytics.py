@@ -0,0 +1,179 @@
+'''
+Workload level analysis of the estimation errors, over NumPy arrays.
+
+load_outputs / load_cache flatten the labeled subsets of many queries into
+one array per attribute (one row per subset), and everything after that is
+vectorized: q-errors, their percentiles by subset size and by table, the
+bias of the estimates, and the worst estimates of the workload.
+
+    data = load_outputs(glob.glob("parsed/*.json"))
+    summary = summarize(data)
+    export_csv(summary, "analytics/")
+'''
+import csv
+import json
+import os
+
+import numpy as np
+
+PERCENTILES = [50, 90, 95, 99]
+
+def _to_arrays(rows, tables):
+    '''
+    @rows: list of (query name, alias tuple, table tuple, actual, expected,
+    derived).
+    @tables: sorted list of all the tables in rows.
+    '''
+    table_idx = {t: i for i, t in enumerate(tables)}
+    queries = sorted(set(r[0] for r in rows))
+    query_idx = {q: i for i, q in enumerate(queries)}
+    membership = np.zeros((len(rows), len(tables)), dtype=bool)
+    for i, row in enumerate(rows):
+        membership[i, [table_idx[t] for t in row[2]]] = True
+
+    def _float(vals):
+        return np.array([np.nan if v is None else v for v in vals],
+                dtype=np.float64)
+
+    return {"queries": queries,
+            "tables": tables,
+            "query": np.array([query_idx[r[0]] for r in rows], dtype=np.int32),
+            "aliases": [r[1] for r in rows],
+            "size": np.array([len(r[1]) for r in rows], dtype=np.int32),
+            "actual": _float(r[3] for r in rows),
+            "expected": _float(r[4] for r in rows),
+            "derived": np.array([bool(r[5]) for r in rows], dtype=bool),
+            "membership": membership}
+
+def load_outputs(fns):
+    '''
+    @fns: json files written from parse_sql's output.
+    @ret: dict of arrays, one row per subset (see _to_arrays).
+    '''
+    rows = []
+    tables = set()
+    for fn in fns:
+        with open(fn, "r") as f:
+            out = json.load(f)
+        name = os.path.splitext(os.path.basename(fn))[0]
+        real_names = {node["id"]: node.get("real_name", node["id"])
+                for node in out["join_graph"]["nodes"]}
+        tables.update(real_names.values())
+        for node in out["subset_graph"]["nodes"]:
+            card = node.get("cardinality")
+            if card is None:
+                continue
+            aliases = tuple(node["id"])
+            rows.append((name, aliases,
+                tuple(set(real_names[a] for a in aliases)),
+                card.get("actual"), card.get("expected"),
+                card.get("derived", False)))
+    return _to_arrays(rows, sorted(tables))
+
+def load_cache(cache_dir):
+    '''
+    like load_outputs, over every query in the subset cache. The cache has
+    no table names, so the aliases stand in for the tables.
+    '''
+    from .subset_cache import read_entries
+    rows = []
+    tables = set()
+    for _, key, subsets in read_entries(cache_dir):
+        for aliases, card in subsets.items():
+            tables.update(aliases)
+            rows.append((key, tuple(aliases), tuple(aliases),
+                card.get("actual"), card.get("expected"),
+                card.get("derived", False)))
+    return _to_arrays(rows, sorted(tables))
+
+def q_errors(actual, expected):
+    '''
+    @ret: max(expected / actual, actual / expected), with both clamped to at
+    least one row; nan where either is missing.
+    '''
+    actual = np.maximum(actual, 1.0)
+    expected = np.maximum(expected, 1.0)
+    return np.maximum(actual / expected, expected / actual)
+
+def _stats(qerr, log_ratio):
+    '''
+    @ret: count, percentiles, max and mean of qerr, and the mean and median
+    of log10(expected / actual) with the fraction of underestimates.
+    '''
+    if len(qerr) == 0:
+        return [0] + [np.nan]*(len(PERCENTILES) + 5)
+    return ([len(qerr)] + list(np.percentile(qerr, PERCENTILES)) +
+            [qerr.max(), qerr.mean(), log_ratio.mean(), np.median(log_ratio),
+             (log_ratio < 0).mean()])
+
+STAT_COLUMNS = (["count"] + ["p{}".format(p) for p in PERCENTILES] +
+        ["max", "mean", "mean_log_bias", "median_log_bias", "under_fraction"])
+
+def summarize(data, num_worst=20):
+    '''
+    @ret: dict of summary tables (lists of rows, with their column names):
+        overall: one row over all the subsets with an estimate
+        by_size: a row per subset size
+        by_table: a row per table, over the subsets containing it
+        by_query: a row per query
+        worst: the num_worst largest q-errors
+    '''
+    valid = np.isfinite(data["actual"]) & np.isfinite(data["expected"])
+    qerr = q_errors(data["actual"][valid], data["expected"][valid])
+    log_ratio = np.log10(np.maximum(data["expected"][valid], 1.0) /
+            np.maximum(data["actual"][valid], 1.0))
+    size = data["size"][valid]
+    query = data["query"][valid]
+    membership = data["membership"][valid]
+
+    summary = {}
+    summary["overall"] = (STAT_COLUMNS, [_stats(qerr, log_ratio)])
+
+    rows = []
+    for s in np.unique(size):
+        mask = size == s
+        rows.append([int(s)] + _stats(qerr[mask], log_ratio[mask]))
+    summary["by_size"] = (["size"] + STAT_COLUMNS, rows)
+
+    rows = []
+    for i, table in enumerate(data["tables"]):
+        mask = membership[:, i]
+        rows.append([table] + _stats(qerr[mask], log_ratio[mask]))
+    summary["by_table"] = (["table"] + STAT_COLUMNS, rows)
+
+    # sort once, and split by query, rather than masking per query
+    order = np.argsort(query, kind="stable")
+    bounds = np.searchsorted(query[order], np.arange(len(data["queries"]) + 1))
+    rows = []
+    for i, name in enumerate(data["queries"]):
+        idx = order[bounds[i]:bounds[i+1]]
+        rows.append([name] + _stats(qerr[idx], log_ratio[idx]))
+    summary["by_query"] = (["query"] + STAT_COLUMNS, rows)
+
+    num_worst = min(num_worst, len(qerr))
+    worst = np.argpartition(-qerr, num_worst - 1)[:num_worst] \
+            if num_worst > 0 else np.array([], dtype=int)
+    worst = worst[np.argsort(-qerr[worst])]
+    valid_idx = np.nonzero(valid)[0]
+    rows = []
+    for i in worst:
+        row = valid_idx[i]
+        rows.append([data["queries"][data["query"][row]],
+            " ".join(data["aliases"][row]), int(data["size"][row]),
+            data["actual"][row], data["expected"][row], qerr[i]])
+    summary["worst"] = (["query", "aliases", "size", "actual", "expected",
+        "q_error"], rows)
+    return summary
+
+def export_csv(summary, out_dir):
+    '''
+    writes <out_dir>/<table>.csv for every summary table.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    for name, (columns, rows) in summary.items():
+        with open(os.path.join(out_dir, name + ".csv"), "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow([round(v, 4) if isinstance(v, float) else v
+                    for v in row])
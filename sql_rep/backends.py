@@ -0,0 +1,470 @@
+'''
+Execution backends: given a join graph and a join order (list of alias tuples,
+smallest first, as built in parse_sql), they return the cardinalities of the
+subsets along that order. Given a join tree (see planner.bushy_cover), they
+return the cardinalities of all the nodes of the tree.
+
+PostgresBackend gets them from the EXPLAIN ANALYZE plan of a single query
+(and also reports the optimizer's estimates). The local backends (DuckDB,
+SQLite) run one exact COUNT(*) per subset over locally loaded tables, which is
+handy for scaled-down datasets and for running the pipeline without a
+database server.
+'''
+import glob
+import os
+import re
+
+from .utils import nodes_to_sql, analyze_plan, \
+        materialize_join_graph, query_fingerprint, connected_order, \
+        tree_to_sql, tree_subsets, rescanned_subsets, variants_count_sql, \
+        compile_query
+from .replicas import ReplicaPool, parse_endpoints
+
+PG_ANALYZE_PREFIX = "explain (analyze, timing off, format json) "
+PG_EXPLAIN_PREFIX = "explain (analyze off, timing off, format json) "
+
+class ExecutionBackend():
+    # whether count_join_order also returns the optimizer's estimates
+    has_estimates = False
+
+    def count_join_order(self, join_graph, join_order):
+        '''
+        @join_order: list of alias tuples; the tables are joined in this order.
+        @ret: list of dicts with the keys:
+            - aliases: sorted list of aliases of the subset
+            - actual: true cardinality
+            - expected: estimated cardinality (only if has_estimates)
+        or None if the execution failed.
+        '''
+        raise NotImplementedError
+
+    def map_join_orders(self, join_graph, join_orders):
+        '''
+        @ret: generator over (index into join_orders, count_join_order
+        result), not necessarily in order.
+        '''
+        for i, join_order in enumerate(join_orders):
+            yield i, self.count_join_order(join_graph, join_order)
+
+    def count_join_tree(self, join_graph, tree):
+        '''
+        @tree: nested pairs of aliases; the tables are joined along the tree.
+        @ret: as count_join_order, for the nodes of the tree.
+        '''
+        raise NotImplementedError
+
+    def map_join_trees(self, join_graph, trees):
+        for i, tree in enumerate(trees):
+            yield i, self.count_join_tree(join_graph, tree)
+
+    def map_estimates(self, join_graph, subsets):
+        '''
+        @ret: generator over (index into subsets, the optimizer's estimated
+        cardinality of the subset, or None without estimates).
+        '''
+        for i in range(len(subsets)):
+            yield i, None
+
+    def count(self, join_graph, aliases):
+        '''
+        @ret: exact cardinality of the subset aliases.
+        '''
+        compiled = compile_query(join_graph)
+        sql = compiled.subset_sql(compiled.mask(aliases))
+        return self.run_sql(sql)[0][0]
+
+    def count_variants(self, join_graphs, aliases):
+        '''
+        @join_graphs: variants of the same query (see variants_count_sql).
+        @ret: list of the exact cardinality of aliases in every variant.
+        '''
+        return list(self.run_sql(variants_count_sql(join_graphs, aliases))[0])
+
+    def map_count_variants(self, requests):
+        '''
+        @requests: list of (join_graphs, aliases).
+        @ret: generator over (index into requests, count_variants result, or
+        None if it failed).
+        '''
+        for i, (join_graphs, aliases) in enumerate(requests):
+            try:
+                yield i, self.count_variants(join_graphs, aliases)
+            except Exception as e:
+                print(e)
+                yield i, None
+
+    def run_sql(self, sql):
+        '''
+        @ret: all rows of the result.
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class PostgresBackend(ExecutionBackend):
+    '''
+    Runs every join order as a single EXPLAIN ANALYZE query with
+    join_collapse_limit 1, spread over all the given replicas.
+
+    With materialize, each filtered alias is first materialized as a temp
+    table (see materialize_join_graph) in every session that runs the query's
+    paths, so the base tables are scanned and filtered once per session
+    instead of once per path. The estimates still come from a plain EXPLAIN
+    of the direct path query, since the ones over the temp tables are not
+    what the optimizer sees for the original query. Temp tables need a
+    writable server, so this does not work on hot standby replicas.
+    @verify_materialized: number of paths per query that are also executed
+    in the direct form, checking that the true counts match.
+    '''
+    has_estimates = True
+
+    def __init__(self, user, db_host, port, pwd, db_name, timeout=False,
+            max_inflight=1, compute_ground_truth=True, materialize=False,
+            verify_materialized=1):
+        self.pool = ReplicaPool(parse_endpoints(db_host, port), user, pwd,
+                db_name, max_inflight=max_inflight)
+        self.compute_ground_truth = compute_ground_truth
+        self.materialize = materialize
+        self.verify_materialized = verify_materialized
+
+        self.pre_exec_sqls = []
+        # TODO: if we use the min #queries approach, maybe greedy approach and
+        # letting pg choose join order is better?
+        self.pre_exec_sqls.append("set join_collapse_limit to 1")
+        self.pre_exec_sqls.append("set from_collapse_limit to 1")
+        if timeout:
+            self.pre_exec_sqls.append("set statement_timeout = {}".format(timeout))
+
+    def explain(self, sql):
+        return self.pool.execute("explain (format json) " + sql, [])
+
+    def run_sql(self, sql):
+        res = self.pool.execute(sql, [])
+        if isinstance(res, (str, Exception)):
+            raise RuntimeError("query failed: {}".format(res))
+        return res
+
+    def join_order_sql(self, join_graph, join_order):
+        sql = compile_query(join_graph).path_sql(join_order,
+                explain=self.explain)
+        if self.compute_ground_truth:
+            return PG_ANALYZE_PREFIX + sql
+        return PG_EXPLAIN_PREFIX + sql
+
+    def join_tree_sql(self, join_graph, tree):
+        sql = tree_to_sql(tree, join_graph)
+        if self.compute_ground_truth:
+            return PG_ANALYZE_PREFIX + sql
+        return PG_EXPLAIN_PREFIX + sql
+
+    def _parse_result(self, res, analyze=None, drop_rescanned=False):
+        '''
+        @drop_rescanned: leave out the joins whose actual rows are per loop
+        (see rescanned_subsets). In a left deep order these are never joins,
+        but in a bushy tree the inner side of a nested loop can be one.
+        '''
+        if analyze is None:
+            analyze = self.compute_ground_truth
+        if res is None or isinstance(res, (str, Exception)):
+            return None
+        plan = res[0][0][0]
+        results = list(analyze_plan(plan["Plan"], analyze=analyze))
+        if not self.compute_ground_truth:
+            for result in results:
+                result.pop("actual", None)
+        elif drop_rescanned:
+            rescanned = list(rescanned_subsets(plan["Plan"]))
+            results = [r for r in results if r["aliases"] not in rescanned]
+        return results
+
+    def count_join_order(self, join_graph, join_order):
+        for _, results in self.map_join_orders(join_graph, [join_order]):
+            return results
+
+    def map_join_orders(self, join_graph, join_orders):
+        if self.materialize and self.compute_ground_truth:
+            join_orders = [self._fix_first_order(join_graph, jo)
+                    for jo in join_orders]
+            yield from self._map_materialized(join_graph, join_orders,
+                    nodes_to_sql)
+            return
+
+        sqls = [self.join_order_sql(join_graph, jo) for jo in join_orders]
+        for i, res in self.pool.map(sqls, self.pre_exec_sqls):
+            yield i, self._parse_result(res)
+
+    def count_join_tree(self, join_graph, tree):
+        for _, results in self.map_join_trees(join_graph, [tree]):
+            return results
+
+    def map_count_variants(self, requests):
+        sqls = [variants_count_sql(join_graphs, aliases)
+                for join_graphs, aliases in requests]
+        # the planner picks the join order here, only keep the timeout
+        pre_execs = [sql for sql in self.pre_exec_sqls
+                if "statement_timeout" in sql]
+        for i, res in self.pool.map(sqls, pre_execs):
+            if res is None or isinstance(res, (str, Exception)):
+                yield i, None
+            else:
+                yield i, list(res[0])
+
+    def map_estimates(self, join_graph, subsets):
+        compiled = compile_query(join_graph)
+        sqls = [PG_EXPLAIN_PREFIX + compiled.subset_sql(compiled.mask(s))
+                for s in subsets]
+        for i, res in self.pool.map(sqls, self.pre_exec_sqls):
+            expected = None
+            for result in self._parse_result(res, analyze=False) or []:
+                if result["aliases"] == list(sorted(subsets[i])):
+                    expected = result.get("expected")
+            yield i, expected
+
+    def map_join_trees(self, join_graph, trees):
+        if self.materialize and self.compute_ground_truth:
+            yield from self._map_materialized(join_graph, trees, tree_to_sql,
+                    drop_rescanned=True)
+            return
+
+        sqls = [self.join_tree_sql(join_graph, tree) for tree in trees]
+        for i, res in self.pool.map(sqls, self.pre_exec_sqls):
+            yield i, self._parse_result(res, drop_rescanned=True)
+
+    def _map_materialized(self, join_graph, plans, to_sql,
+            drop_rescanned=False):
+        '''
+        @plans: join orders or join trees.
+        @to_sql: nodes_to_sql or tree_to_sql, to build their queries.
+        '''
+        key = "mat_" + query_fingerprint(join_graph)[0:8]
+        mat_graph, setup_sqls, cleanup_sqls = materialize_join_graph(join_graph,
+                key)
+        session = (key, setup_sqls)
+
+        sqls = [PG_ANALYZE_PREFIX + to_sql(plan, mat_graph) for plan in plans]
+        estimate_sqls = ["explain (format json) " + to_sql(plan, join_graph)
+                for plan in plans]
+
+        try:
+            for i, res in self.pool.map(sqls, self.pre_exec_sqls, session=session):
+                results = self._parse_result(res, drop_rescanned=drop_rescanned)
+                if results is None:
+                    yield i, None
+                    continue
+
+                estimates = self._parse_result(self.pool.execute(
+                    estimate_sqls[i], self.pre_exec_sqls), analyze=False)
+                expected = {}
+                for est in estimates or []:
+                    expected[tuple(est["aliases"])] = est["expected"]
+                for result in results:
+                    result["expected"] = expected.get(tuple(result["aliases"]))
+
+                if i < self.verify_materialized:
+                    self._verify(join_graph, plans[i], results, to_sql)
+                yield i, results
+        finally:
+            self.pool.close_session(key, cleanup_sqls)
+
+    def _fix_first_order(self, join_graph, join_order):
+        '''
+        pg may order a multi relation first element differently over the temp
+        tables than over the base tables, and then the estimates would belong
+        to other subsets; so spell it out as single relations.
+        '''
+        if len(join_order[0]) == 1:
+            return join_order
+        first = [(a,) for a in connected_order(join_graph, join_order[0])]
+        return first + list(join_order[1:])
+
+    def _verify(self, join_graph, plan, results, to_sql):
+        direct_sql = PG_ANALYZE_PREFIX + to_sql(plan, join_graph)
+        direct = self._parse_result(self.pool.execute(direct_sql,
+            self.pre_exec_sqls), drop_rescanned=True)
+        if direct is None:
+            print("could not run the direct form to verify the materialized one")
+            return
+        actual = {tuple(r["aliases"]): r["actual"] for r in results}
+        for r in direct:
+            aliases = tuple(r["aliases"])
+            assert aliases not in actual or actual[aliases] == r["actual"], \
+                "materialized count of {} is {}, direct count is {}".format(
+                        aliases, actual[aliases], r["actual"])
+
+class LocalBackend(ExecutionBackend):
+    '''
+    Common parts of the in-process engines: every subset along the join order
+    is counted with its own COUNT(*) query, built by CompiledQuery.
+
+    @materialize, verify_materialized: as in PostgresBackend, except that the
+    temp tables are created once per map_join_orders call.
+    '''
+    def __init__(self, materialize=False, verify_materialized=1):
+        self.con = None
+        self.materialize = materialize
+        self.verify_materialized = verify_materialized
+
+    def count(self, join_graph, aliases):
+        compiled = compile_query(join_graph)
+        sql = compiled.subset_sql(compiled.mask(aliases))
+        return self.run_sql(quote_aliases(sql, aliases))[0][0]
+
+    def count_variants(self, join_graphs, aliases):
+        sql = variants_count_sql(join_graphs, aliases)
+        return list(self.run_sql(quote_aliases(sql, aliases))[0])
+
+    def count_join_order(self, join_graph, join_order):
+        results = []
+        aliases = []
+        for rels in join_order:
+            aliases += list(rels)
+            try:
+                actual = self.count(join_graph, aliases)
+            except Exception as e:
+                print(e)
+                return None
+            results.append({"aliases": list(sorted(aliases)),
+                            "actual": actual})
+        return results
+
+    def count_join_tree(self, join_graph, tree):
+        results = []
+        for aliases in tree_subsets(tree):
+            try:
+                actual = self.count(join_graph, aliases)
+            except Exception as e:
+                print(e)
+                return None
+            results.append({"aliases": list(aliases), "actual": actual})
+        return results
+
+    def map_join_orders(self, join_graph, join_orders):
+        if not self.materialize:
+            yield from super().map_join_orders(join_graph, join_orders)
+            return
+        yield from self._map_materialized(join_graph, join_orders,
+                self.count_join_order)
+
+    def map_join_trees(self, join_graph, trees):
+        if not self.materialize:
+            yield from super().map_join_trees(join_graph, trees)
+            return
+        yield from self._map_materialized(join_graph, trees,
+                self.count_join_tree)
+
+    def _map_materialized(self, join_graph, plans, count_fn):
+        '''
+        @count_fn: count_join_order or count_join_tree.
+        '''
+        key = "mat_" + query_fingerprint(join_graph)[0:8]
+        mat_graph, setup_sqls, cleanup_sqls = materialize_join_graph(join_graph,
+                key)
+        for setup_sql in setup_sqls:
+            self.run_sql(quote_aliases(setup_sql, join_graph.nodes))
+        try:
+            for i, plan in enumerate(plans):
+                results = count_fn(mat_graph, plan)
+                if results is not None and i < self.verify_materialized:
+                    direct = count_fn(join_graph, plan)
+                    assert direct == results, \
+                        "materialized counts {} differ from direct counts {}" \
+                        .format(results, direct)
+                yield i, results
+        finally:
+            for cleanup_sql in cleanup_sqls:
+                self.run_sql(cleanup_sql)
+
+    def run_sql(self, sql):
+        # not through a cursor: duckdb cursors are separate connections, which
+        # would not see our temp tables
+        return self.con.execute(sql).fetchall()
+
+    def close(self):
+        if self.con is not None:
+            self.con.close()
+            self.con = None
+
+def quote_aliases(sql, aliases):
+    '''
+    postgres accepts aliases like "at", which are reserved words in duckdb,
+    so quote all aliases outside of the string literals of sql.
+    '''
+    alias_re = re.compile(r"\b({})\b(?=\.|\s|$|,|\))".format(
+        "|".join(re.escape(a) for a in aliases)))
+    # odd pieces are string literals
+    pieces = re.split(r"('(?:[^']|'')*')", sql)
+    for i in range(0, len(pieces), 2):
+        pieces[i] = alias_re.sub(r'"\1"', pieces[i])
+    return "".join(pieces)
+
+class DuckDBBackend(LocalBackend):
+    '''
+    @database: duckdb database file, or ":memory:".
+    @data_dir: if given, every <table>.csv / <table>.parquet file in it is
+    loaded as the table <table>.
+    '''
+    def __init__(self, database=":memory:", data_dir=None, **kwargs):
+        super().__init__(**kwargs)
+        try:
+            import duckdb
+        except ImportError:
+            raise ImportError("DuckDBBackend needs the duckdb package")
+        self.con = duckdb.connect(database)
+        if data_dir is not None:
+            self.load_tables(data_dir)
+
+    def load_tables(self, data_dir):
+        for fn in sorted(glob.glob(os.path.join(data_dir, "*"))):
+            table, ext = os.path.splitext(os.path.basename(fn))
+            if ext == ".csv":
+                reader = "read_csv_auto"
+            elif ext == ".parquet":
+                reader = "read_parquet"
+            else:
+                continue
+            self.con.execute("CREATE OR REPLACE TABLE {} AS SELECT * FROM {}('{}')"
+                    .format(table, reader, fn))
+
+class SQLiteBackend(LocalBackend):
+    '''
+    @database: sqlite database file, or ":memory:". Since sqlite only comes
+    with the standard library, this is the fallback when duckdb is not
+    installed.
+    '''
+    def __init__(self, database=":memory:", data_dir=None, **kwargs):
+        super().__init__(**kwargs)
+        import sqlite3
+        self.con = sqlite3.connect(database)
+        # postgres' LIKE is case sensitive
+        self.con.execute("PRAGMA case_sensitive_like = ON")
+        if data_dir is not None:
+            self.load_tables(data_dir)
+
+    def load_tables(self, data_dir):
+        import csv
+        for fn in sorted(glob.glob(os.path.join(data_dir, "*.csv"))):
+            table = os.path.splitext(os.path.basename(fn))[0]
+            with open(fn, "r") as f:
+                reader = csv.reader(f)
+                header = next(reader)
+                self.con.execute("DROP TABLE IF EXISTS {}".format(table))
+                # numeric affinity, so that numbers compare as numbers
+                self.con.execute("CREATE TABLE {} ({})".format(table,
+                    ", ".join(c + " NUMERIC" for c in header)))
+                insert = "INSERT INTO {} VALUES ({})".format(table,
+                        ", ".join(["?"]*len(header)))
+                # empty fields are NULLs, as in postgres' csv COPY
+                self.con.executemany(insert, ([v if v != "" else None
+                    for v in row] for row in reader))
+        self.con.commit()
+
+def get_backend(name, **kwargs):
+    '''
+    @name: postgres, duckdb or sqlite; kwargs go to the backend's constructor.
+    '''
+    backends = {"postgres": PostgresBackend,
+                "duckdb": DuckDBBackend,
+                "sqlite": SQLiteBackend}
+    assert name in backends, "unknown backend {}".format(name)
+    return backends[name](**kwargs)
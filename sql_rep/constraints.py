@@ -0,0 +1,153 @@
+'''
+Key constraints, and the subsets whose cardinality follows from them.
+
+If a subset T = S + {p} joins p to S by a single edge fk.col = p.key, where
+p.key is a (single column) primary / unique key, fk.col is a NOT NULL
+foreign key to it, and p has no filter, then every row of S matches exactly
+one row of p, so |T| = |S|. parse_sql can then leave T out of the path
+planning, and fill it in from S afterwards.
+
+Constraints come from the postgres catalog, or from a JSON schema file:
+
+    {"primary_keys": {"title": ["id"], ...},
+     "foreign_keys": [["movie_companies.movie_id", "title.id"], ...],
+     "not_null": {"movie_companies": ["movie_id", ...], ...}}
+
+Keys are NOT NULL anyway, so they need not be listed under not_null. A
+schema file is taken at its word, and the catalog only holds what is
+declared and enforced, so see verify_derived in parse_sql to spot check
+either against the data.
+'''
+import json
+import re
+
+JOIN_RE = re.compile(r"^\s*(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)\s*$")
+
+CATALOG_KEYS_SQL = """
+SELECT c.contype, rel.relname, frel.relname,
+    ARRAY(SELECT a.attname FROM unnest(c.conkey) k JOIN pg_attribute a
+        ON a.attrelid = c.conrelid AND a.attnum = k),
+    ARRAY(SELECT a.attname FROM unnest(c.confkey) k JOIN pg_attribute a
+        ON a.attrelid = c.confrelid AND a.attnum = k)
+FROM pg_constraint c
+JOIN pg_class rel ON rel.oid = c.conrelid
+JOIN pg_namespace n ON n.oid = rel.relnamespace
+LEFT JOIN pg_class frel ON frel.oid = c.confrelid
+WHERE c.contype IN ('p', 'u', 'f') AND n.nspname = 'public'
+"""
+
+CATALOG_NOT_NULL_SQL = """
+SELECT c.relname, a.attname
+FROM pg_attribute a
+JOIN pg_class c ON c.oid = a.attrelid
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE a.attnotnull AND a.attnum > 0 AND NOT a.attisdropped
+AND c.relkind = 'r' AND n.nspname = 'public'
+"""
+
+class KeyConstraints():
+    '''
+    @primary_keys: dict from table to its single column keys (primary or
+    unique).
+    @foreign_keys: list of ((table, column), (referenced table, column)).
+    @not_null: dict from table to its NOT NULL columns.
+    '''
+    def __init__(self, primary_keys={}, foreign_keys=[], not_null={}):
+        self.primary_keys = {t: set(cols) for t, cols in primary_keys.items()}
+        self.foreign_keys = set((tuple(fk), tuple(ref))
+                for fk, ref in foreign_keys)
+        self.not_null = {t: set(cols) for t, cols in not_null.items()}
+        for table, cols in self.primary_keys.items():
+            self.not_null.setdefault(table, set()).update(cols)
+
+    @classmethod
+    def from_file(cls, fn):
+        with open(fn, "r") as f:
+            schema = json.load(f)
+        foreign_keys = [(fk.split("."), ref.split("."))
+                for fk, ref in schema.get("foreign_keys", [])]
+        return cls(schema.get("primary_keys", {}), foreign_keys,
+                schema.get("not_null", {}))
+
+    @classmethod
+    def from_catalog(cls, backend):
+        '''
+        @backend: a PostgresBackend; only single column keys are used.
+        '''
+        primary_keys = {}
+        foreign_keys = []
+        for contype, table, ref_table, cols, ref_cols in \
+                backend.run_sql(CATALOG_KEYS_SQL):
+            # psycopg2 gives name[] back as a "{a,b}" string
+            if isinstance(cols, str):
+                cols = cols.strip("{}").split(",")
+                ref_cols = ref_cols.strip("{}").split(",")
+            if len(cols) != 1:
+                continue
+            if contype in ("p", "u"):
+                primary_keys.setdefault(table, []).append(cols[0])
+            else:
+                foreign_keys.append(((table, cols[0]), (ref_table, ref_cols[0])))
+
+        not_null = {}
+        for table, col in backend.run_sql(CATALOG_NOT_NULL_SQL):
+            not_null.setdefault(table, []).append(col)
+        return cls(primary_keys, foreign_keys, not_null)
+
+    def to_file(self, fn):
+        schema = {"primary_keys": {t: sorted(c) for t, c in
+                    self.primary_keys.items()},
+                  "foreign_keys": sorted([".".join(fk), ".".join(ref)]
+                      for fk, ref in self.foreign_keys),
+                  "not_null": {t: sorted(c) for t, c in self.not_null.items()}}
+        with open(fn, "w") as f:
+            json.dump(schema, f, indent=1, sort_keys=True)
+
+    def is_key_join(self, fk_table, fk_col, key_table, key_col):
+        '''
+        @ret: True if every row of fk_table matches exactly one row of
+        key_table on fk_col = key_col.
+        '''
+        return key_col in self.primary_keys.get(key_table, ()) and \
+                fk_col in self.not_null.get(fk_table, ()) and \
+                ((fk_table, fk_col), (key_table, key_col)) in self.foreign_keys
+
+def _key_side(join_graph, alias, neighbor, constraints):
+    '''
+    @ret: True if joining alias to neighbor is a key join that doesn't change
+    the cardinality of neighbor's side.
+    '''
+    m = JOIN_RE.match(join_graph[alias][neighbor]["join_condition"])
+    if m is None:
+        return False
+    a1, c1, a2, c2 = m.groups()
+    if a1 == alias and a2 == neighbor:
+        key_col, fk_col = c1, c2
+    elif a2 == alias and a1 == neighbor:
+        key_col, fk_col = c2, c1
+    else:
+        return False
+    return constraints.is_key_join(join_graph.nodes[neighbor]["real_name"],
+            fk_col, join_graph.nodes[alias]["real_name"], key_col)
+
+def derivable_subsets(join_graph, subset_graph, constraints):
+    '''
+    @ret: dict from every subset T whose cardinality equals that of a smaller
+    subset (see the module docstring) to that subset. The smaller one may be
+    derivable itself, but following the chain always ends at one that is
+    not.
+    '''
+    derived = {}
+    for node in subset_graph.nodes:
+        if len(node) < 2:
+            continue
+        for alias in node:
+            if len(join_graph.nodes[alias]["predicates"]) > 0:
+                continue
+            neighbors = [n for n in join_graph.neighbors(alias) if n in node]
+            if len(neighbors) != 1:
+                continue
+            if _key_side(join_graph, alias, neighbors[0], constraints):
+                derived[node] = tuple(a for a in node if a != alias)
+                break
+    return derived
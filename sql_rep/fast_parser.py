@@ -0,0 +1,369 @@
+'''
+Tokenizer and parser for the conjunctive fragment our workloads are written
+in:
+
+    SELECT ... FROM t1 AS a1, t2 AS a2, ... WHERE p1 AND p2 AND ...
+
+where every conjunct p is either a join (a1.x = a2.y) or a filter on a single
+alias built from comparisons, [NOT] LIKE / ILIKE, [NOT] IN, [NOT] BETWEEN,
+IS [NOT] NULL, NOT, and parenthesized OR / AND groups. Anything else raises
+UnsupportedQuery, and extract_join_graph falls back to the sqlparse based
+path.
+'''
+import re
+
+TOKEN_RE = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<number>\d+(?:\.\d+)?)
+  | (?P<name>[A-Za-z_][A-Za-z_0-9]*(?:\.[A-Za-z_][A-Za-z_0-9]*)?)
+  | (?P<quoted>"[^"]+")
+  | (?P<op><=|>=|<>|!=|::|=|<|>|~|\*|-|\+|/)
+  | (?P<punct>[(),;])
+""", re.VERBOSE)
+
+COMPARISON_OPS = set(["=", "!=", "<>", "<", "<=", ">", ">=", "~"])
+LITERAL_KEYWORDS = set(["NULL", "TRUE", "FALSE"])
+# keywords that end the WHERE clause of a non conjunctive query
+CLAUSE_KEYWORDS = set(["GROUP", "ORDER", "HAVING", "LIMIT", "UNION",
+    "EXCEPT", "INTERSECT", "JOIN", "ON", "SELECT"])
+
+class UnsupportedQuery(Exception):
+    pass
+
+class Token():
+    __slots__ = ("kind", "value", "start", "end")
+
+    def __init__(self, kind, value, start, end):
+        self.kind = kind
+        self.value = value
+        self.start = start
+        self.end = end
+
+    def upper(self):
+        return self.value.upper()
+
+    def is_keyword(self, *words):
+        return self.kind == "name" and self.value.upper() in words
+
+def tokenize(sql):
+    '''
+    @ret: list of Tokens, without whitespace.
+    '''
+    tokens = []
+    pos = 0
+    while pos < len(sql):
+        m = TOKEN_RE.match(sql, pos)
+        if m is None:
+            raise UnsupportedQuery("can't tokenize {}".format(sql[pos:pos+20]))
+        kind = m.lastgroup
+        if kind != "ws":
+            tokens.append(Token(kind, m.group(), m.start(), m.end()))
+        pos = m.end()
+    return tokens
+
+def _split_top_level(tokens, keyword):
+    '''
+    splits tokens on keyword outside of parentheses. The AND of a BETWEEN is
+    not a split point.
+    '''
+    parts = [[]]
+    depth = 0
+    pending_between = 0
+    for tok in tokens:
+        if tok.value == "(":
+            depth += 1
+        elif tok.value == ")":
+            depth -= 1
+            if depth < 0:
+                raise UnsupportedQuery("unbalanced parentheses")
+        elif depth == 0 and tok.is_keyword("BETWEEN"):
+            pending_between += 1
+        elif depth == 0 and tok.is_keyword(keyword):
+            if keyword == "AND" and pending_between > 0:
+                pending_between -= 1
+            else:
+                parts.append([])
+                continue
+        parts[-1].append(tok)
+    if depth != 0:
+        raise UnsupportedQuery("unbalanced parentheses")
+    for part in parts:
+        if len(part) == 0:
+            raise UnsupportedQuery("empty {} operand".format(keyword))
+    return parts
+
+class _PredicateParser():
+    '''
+    recursive descent over the tokens of one conjunct; collects the column
+    references (alias.column tokens).
+    '''
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.columns = []
+        # (op, left operand, right operand) of a plain comparison conjunct
+        self.comparison = None
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return None
+
+    def next(self):
+        tok = self.peek()
+        if tok is None:
+            raise UnsupportedQuery("unexpected end of predicate")
+        self.pos += 1
+        return tok
+
+    def expect(self, value):
+        tok = self.next()
+        if tok.upper() != value:
+            raise UnsupportedQuery("expected {}, got {}".format(value, tok.value))
+
+    def parse(self):
+        self.parse_predicate()
+        if self.peek() is not None:
+            raise UnsupportedQuery("trailing tokens: {}".format(self.peek().value))
+
+    def parse_predicate(self):
+        tok = self.peek()
+        if tok is not None and tok.is_keyword("NOT"):
+            self.next()
+            self.parse_predicate()
+            # NOT a.x = b.y is no join; sqlparse keeps it as it is
+            comparison = self.comparison
+            if comparison is not None and comparison[1] is not None and \
+                    comparison[2] is not None and \
+                    comparison[1].value.split(".")[0] != \
+                    comparison[2].value.split(".")[0]:
+                raise UnsupportedQuery("negated join condition")
+            self.comparison = None
+            return
+
+        if tok is not None and tok.value == "(":
+            # a parenthesized boolean group, unless it is e.g. (a.x) = 1
+            end = self._matching_paren(self.pos)
+            inner = self.tokens[self.pos+1:end]
+            if self._is_boolean(inner):
+                for conj in _split_top_level(inner, "OR"):
+                    for atom in _split_top_level(conj, "AND"):
+                        sub = _PredicateParser(atom)
+                        sub.parse()
+                        self.columns += sub.columns
+                self.pos = end + 1
+                return
+
+        left = self.parse_operand()
+        tok = self.next()
+        op = tok.upper()
+        negated = False
+        if op == "NOT":
+            negated = True
+            tok = self.next()
+            op = tok.upper()
+
+        if op in COMPARISON_OPS and not negated:
+            right = self.parse_operand()
+            self.comparison = (tok.value, left, right)
+        elif op in ("LIKE", "ILIKE"):
+            self.parse_operand()
+        elif op == "IN":
+            self.expect("(")
+            self.parse_operand()
+            while self.peek() is not None and self.peek().value == ",":
+                self.next()
+                self.parse_operand()
+            self.expect(")")
+        elif op == "BETWEEN":
+            self.parse_operand()
+            self.expect("AND")
+            self.parse_operand()
+        elif op == "IS" and not negated:
+            if self.peek() is not None and self.peek().is_keyword("NOT"):
+                self.next()
+            self.expect("NULL")
+        else:
+            raise UnsupportedQuery("unsupported operator {}".format(tok.value))
+
+    def parse_operand(self):
+        '''
+        @ret: the column token if the operand is a bare column, else None.
+        '''
+        tok = self.next()
+        column = None
+        if tok.value == "-" or tok.value == "+":
+            tok = self.next()
+            if tok.kind != "number":
+                raise UnsupportedQuery("unsupported operand")
+        elif tok.kind == "name" and "." in tok.value:
+            self.columns.append(tok)
+            column = tok
+        elif tok.kind in ("string", "number"):
+            pass
+        elif tok.kind == "name" and tok.upper() in LITERAL_KEYWORDS:
+            pass
+        else:
+            raise UnsupportedQuery("unsupported operand {}".format(tok.value))
+
+        # casts, e.g. mi.info::float
+        while self.peek() is not None and self.peek().value == "::":
+            self.next()
+            if self.next().kind != "name":
+                raise UnsupportedQuery("unsupported cast")
+            column = None
+        return column
+
+    def _matching_paren(self, start):
+        depth = 0
+        for i in range(start, len(self.tokens)):
+            if self.tokens[i].value == "(":
+                depth += 1
+            elif self.tokens[i].value == ")":
+                depth -= 1
+                if depth == 0:
+                    return i
+        raise UnsupportedQuery("unbalanced parentheses")
+
+    def _is_boolean(self, tokens):
+        for tok in tokens:
+            if tok.kind == "name" and "." not in tok.value and \
+                    tok.upper() not in LITERAL_KEYWORDS:
+                return True
+            if tok.kind == "op" and tok.value in COMPARISON_OPS:
+                return True
+        return False
+
+def _parse_from(tokens):
+    '''
+    @ret: froms, aliases, tables as in extract_from_clause.
+    '''
+    froms = []
+    aliases = {}
+    tables = []
+    items = [[]]
+    for tok in tokens:
+        if tok.value == ",":
+            items.append([])
+        else:
+            items[-1].append(tok)
+
+    for item in items:
+        if len(item) == 3 and item[1].is_keyword("AS"):
+            item = [item[0], item[2]]
+        if len(item) != 2 or any(t.kind != "name" or "." in t.value
+                for t in item):
+            raise UnsupportedQuery("unsupported FROM item")
+        table, alias = item[0].value, item[1].value
+        tables.append(table)
+        froms.append("{} AS {}".format(table, alias))
+        aliases[alias] = table
+
+    return froms, aliases, tables
+
+def parse_conjunctive(sql):
+    '''
+    @ret:
+        froms, aliases, tables: as in extract_from_clause.
+        joins: list of join conditions, "a1.x = a2.y", as in
+        extract_join_clause.
+        predicates: dict from alias to the list of its filter predicates,
+        each a " " prefixed slice of sql (like find_all_clauses gives them).
+    '''
+    tokens = tokenize(sql)
+    while len(tokens) > 0 and tokens[-1].value == ";":
+        tokens = tokens[:-1]
+
+    if len(tokens) == 0 or not tokens[0].is_keyword("SELECT"):
+        raise UnsupportedQuery("not a SELECT")
+
+    from_idx = None
+    where_idx = None
+    depth = 0
+    for i, tok in enumerate(tokens):
+        if tok.value == "(":
+            depth += 1
+        elif tok.value == ")":
+            depth -= 1
+        elif tok.value == ";":
+            raise UnsupportedQuery("several statements")
+        elif depth == 0 and tok.is_keyword("FROM") and from_idx is None:
+            from_idx = i
+        elif depth == 0 and tok.is_keyword("WHERE") and where_idx is None:
+            where_idx = i
+        elif i > 0 and tok.kind == "name" and tok.upper() in CLAUSE_KEYWORDS:
+            raise UnsupportedQuery("unsupported clause {}".format(tok.value))
+
+    if from_idx is None or where_idx is None or where_idx < from_idx:
+        raise UnsupportedQuery("no FROM ... WHERE")
+
+    froms, aliases, tables = _parse_from(tokens[from_idx+1:where_idx])
+
+    joins = []
+    predicates = {}
+    for conj in _split_top_level(tokens[where_idx+1:], "AND"):
+        parser = _PredicateParser(conj)
+        parser.parse()
+        used = set()
+        for col in parser.columns:
+            alias = col.value.split(".")[0]
+            if alias not in aliases:
+                raise UnsupportedQuery("unknown alias {}".format(alias))
+            used.add(alias)
+
+        text = sql[conj[0].start:conj[-1].end]
+        if len(used) == 0:
+            # e.g. 1 = 1; these never made it into the join graph
+            continue
+        if len(used) == 1:
+            predicates.setdefault(used.pop(), []).append(" " + text)
+            continue
+
+        comparison = parser.comparison
+        if len(used) == 2 and comparison is not None \
+                and comparison[0] in ("=", "!=") \
+                and comparison[1] is not None and comparison[2] is not None:
+            joins.append("{} {} {}".format(comparison[1].value,
+                comparison[0], comparison[2].value))
+            continue
+
+        raise UnsupportedQuery("predicate over several aliases: {}".format(text))
+
+    return froms, aliases, tables, joins, predicates
+
+def _normalize(clause):
+    clause = clause.replace(";", "")
+    return " ".join(clause.split())
+
+def check_parity(sql, fast_graph, slow_graph):
+    '''
+    @ret: list of differences between the join graphs of sql built with and
+    without the fast parser; predicates are compared up to whitespace.
+    '''
+    diffs = []
+    if set(fast_graph.nodes) != set(slow_graph.nodes):
+        diffs.append("nodes: {} vs {}".format(sorted(fast_graph.nodes),
+            sorted(slow_graph.nodes)))
+        return diffs
+
+    for node in fast_graph.nodes:
+        fast = fast_graph.nodes[node]
+        slow = slow_graph.nodes[node]
+        if fast.get("real_name") != slow.get("real_name"):
+            diffs.append("{} real_name: {} vs {}".format(node,
+                fast.get("real_name"), slow.get("real_name")))
+        fast_preds = [_normalize(p) for p in fast["predicates"]]
+        slow_preds = [_normalize(p) for p in slow["predicates"]]
+        if fast_preds != slow_preds:
+            diffs.append("{} predicates: {} vs {}".format(node, fast_preds,
+                slow_preds))
+
+    fast_edges = {tuple(sorted(e[0:2])): _normalize(e[2]["join_condition"])
+            for e in fast_graph.edges(data=True)}
+    slow_edges = {tuple(sorted(e[0:2])): _normalize(e[2]["join_condition"])
+            for e in slow_graph.edges(data=True)}
+    if fast_edges != slow_edges:
+        diffs.append("edges: {} vs {}".format(fast_edges, slow_edges))
+
+    return diffs
@@ -0,0 +1,306 @@
+'''
+Read-only lookups of the computed cardinalities, by (query fingerprint,
+subset).
+
+A subset is given either as a collection of aliases, or as a bitmask over
+all the query's aliases in sorted order (bit i is aliases(fingerprint)[i],
+the same layout as utils.CompiledQuery.mask), which is the cheapest to look
+up. The layout depends on the query only, so it doesn't change as more of
+its subsets get labeled. Every lookup returns the (actual, expected) tuple of
+the subset, with None for what was not computed, or None if the subset is
+unknown. Masks need the query's aliases, which the subset cache keeps for
+the entries written with them; for older ones only alias lookups work.
+
+CardinalityIndex loads the subset cache once, and reload() swaps in a fresh
+index in a single assignment, so readers never see a half built one.
+serve_unix / serve_http expose an index to other processes: every request
+is a JSON object {"fingerprint": ..., "subsets": [[alias, ...], ...]} (or
+"masks": [int, ...]) and the response is {"results": [[actual, expected] or
+null, ...]}. {"fingerprint": ..., "aliases": true} returns the mask layout,
+as {"aliases": [alias, ...] or null}.
+'''
+import json
+import re
+import threading
+import time
+
+from .subset_cache import read_entries, query_aliases, cache_version
+
+FINGERPRINT_RE = re.compile("^[0-9a-f]{40}$")
+
+class CardinalityIndex():
+    '''
+    @cache_dir: subset cache directory, as used by parse_sql.
+    @check_interval: maybe_reload looks at the cache at most this often
+    (seconds).
+    '''
+    def __init__(self, cache_dir, check_interval=5.0):
+        self.cache_dir = cache_dir
+        self.check_interval = check_interval
+        self.last_check = 0.0
+        self.version = None
+        self._index = {}
+        self.reload_lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        '''
+        rebuilds the index from the cache, and swaps it in.
+        @ret: number of indexed queries.
+        '''
+        with self.reload_lock:
+            version = cache_version(self.cache_dir)
+            layouts = query_aliases(self.cache_dir)
+            # fingerprint -> (subsets, aliases), legacy entries first, so
+            # that the fingerprinted entry of the same query wins
+            legacy = {}
+            queries = {}
+            for _, key, subsets in read_entries(self.cache_dir):
+                if FINGERPRINT_RE.match(key):
+                    queries[key] = (subsets, layouts.get(key))
+                    continue
+                # entries from before fingerprinting are keyed by the sql
+                from .utils import extract_join_graph, query_fingerprint
+                try:
+                    join_graph = extract_join_graph(key)
+                except Exception as e:
+                    print("skipping cache key we can't parse:", e)
+                    continue
+                legacy[query_fingerprint(join_graph)] = (subsets,
+                        sorted(join_graph.nodes))
+
+            index = {}
+            for fingerprint in legacy.keys() | queries.keys():
+                subsets, aliases = legacy.get(fingerprint, ({}, None))
+                if fingerprint in queries:
+                    subsets = dict(subsets)
+                    subsets.update(queries[fingerprint][0])
+                    aliases = queries[fingerprint][1] or aliases
+                index[fingerprint] = _index_query(subsets, aliases)
+            self._index = index
+            self.version = version
+            self.last_check = time.time()
+        return len(index)
+
+    def maybe_reload(self):
+        '''
+        reloads if the cache changed since the last (re)load.
+        @ret: True if it reloaded.
+        '''
+        if time.time() - self.last_check < self.check_interval:
+            return False
+        self.last_check = time.time()
+        if cache_version(self.cache_dir) == self.version:
+            return False
+        self.reload()
+        return True
+
+    def fingerprints(self):
+        return list(self._index.keys())
+
+    def aliases(self, fingerprint):
+        '''
+        @ret: the sorted aliases of the query, bit i of a mask is aliases[i];
+        None if the query is unknown, or its aliases weren't stored.
+        '''
+        query = self._index.get(fingerprint)
+        if query is None:
+            return None
+        return query[0]
+
+    def mask(self, fingerprint, aliases):
+        assert self.aliases(fingerprint) is not None, \
+                "no mask layout for {}".format(fingerprint)
+        bits = self._index[fingerprint][1]
+        return sum(bits[a] for a in aliases)
+
+    def lookup_mask(self, fingerprint, mask):
+        query = self._index.get(fingerprint)
+        if query is None or query[0] is None:
+            return None
+        return query[2].get(mask)
+
+    def lookup(self, fingerprint, aliases):
+        '''
+        @aliases: collection of aliases of the subset.
+        '''
+        query = self._index.get(fingerprint)
+        if query is None:
+            return None
+        bits = query[1]
+        try:
+            mask = sum(bits[a] for a in aliases)
+        except KeyError:
+            return None
+        return query[2].get(mask)
+
+    def lookup_many(self, fingerprint, subsets=None, masks=None):
+        '''
+        batched lookup of a list of alias collections, or of masks.
+        @ret: list of results, in order.
+        '''
+        # one reference for the whole batch, even if a reload happens
+        query = self._index.get(fingerprint)
+        if query is None or (masks is not None and query[0] is None):
+            return [None]*len(subsets if masks is None else masks)
+        bits, cards = query[1], query[2]
+        if masks is not None:
+            return [cards.get(m) for m in masks]
+        ret = []
+        for aliases in subsets:
+            try:
+                ret.append(cards.get(sum(bits[a] for a in aliases)))
+            except KeyError:
+                ret.append(None)
+        return ret
+
+    def handle(self, request):
+        '''
+        @request: dict as described in the module docstring.
+        @ret: the response dict.
+        '''
+        fingerprint = request.get("fingerprint")
+        if request.get("aliases"):
+            return {"aliases": self.aliases(fingerprint)}
+        if "masks" in request:
+            results = self.lookup_many(fingerprint, masks=request["masks"])
+        else:
+            results = self.lookup_many(fingerprint,
+                    subsets=request.get("subsets", []))
+        return {"results": results}
+
+def _index_query(subsets, aliases):
+    '''
+    @subsets: dict from sorted alias tuples to {"actual": .., "expected": ..}
+    @aliases: all the aliases of the query, or None if they aren't known.
+    Then the bits only serve the alias lookups, and masks aren't supported.
+    @ret: (sorted aliases or None, alias -> bit, mask -> (actual, expected))
+    '''
+    if aliases is not None:
+        aliases = sorted(aliases)
+        layout = aliases
+    else:
+        layout = sorted(set(a for key in subsets for a in key))
+    bits = {a: 1 << i for i, a in enumerate(layout)}
+    cards = {}
+    for key, card in subsets.items():
+        cards[sum(bits[a] for a in key)] = (card.get("actual"),
+                card.get("expected"))
+    return (aliases, bits, cards)
+
+def _handle_line(index, line):
+    try:
+        response = index.handle(json.loads(line))
+    except Exception as e:
+        response = {"error": str(e)}
+    return (json.dumps(response) + "\n").encode("utf-8")
+
+def serve_unix(index, path):
+    '''
+    serves newline delimited JSON requests on the unix socket path, till
+    interrupted.
+    '''
+    import os
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                index.maybe_reload()
+                self.wfile.write(_handle_line(index, line))
+                self.wfile.flush()
+
+    if os.path.exists(path):
+        os.remove(path)
+    with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+        # don't wait for idle clients on exit
+        server.daemon_threads = True
+        print("serving", index.cache_dir, "on", path)
+        server.serve_forever()
+
+def serve_http(index, host="localhost", port=8765):
+    '''
+    serves POST /lookup with a JSON request body,
+    GET /lookup?fingerprint=..&aliases=a,b,c for a single subset, and
+    GET /aliases?fingerprint=.. for the mask layout of a query.
+    '''
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, body):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path not in ("/lookup", "/aliases"):
+                self.send_error(404)
+                return
+            params = parse_qs(url.query)
+            index.maybe_reload()
+            request = {"fingerprint": params.get("fingerprint", [""])[0]}
+            if url.path == "/aliases":
+                request["aliases"] = True
+            else:
+                request["subsets"] = [params.get("aliases", [""])[0].split(",")]
+            self._reply(_handle_line(index, json.dumps(request)))
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/lookup":
+                self.send_error(404)
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            index.maybe_reload()
+            self._reply(_handle_line(index, self.rfile.read(length)))
+
+        def log_message(self, format, *args):
+            pass
+
+    with ThreadingHTTPServer((host, port), Handler) as server:
+        print("serving", index.cache_dir, "on http://{}:{}".format(host, port))
+        server.serve_forever()
+
+class LookupClient():
+    '''
+    client of serve_unix, keeping the connection open across lookups.
+    '''
+    def __init__(self, path):
+        import socket
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.reader = self.sock.makefile("rb")
+
+    def _call(self, request):
+        self.sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        response = json.loads(self.reader.readline())
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    def request(self, request):
+        return [tuple(r) if r is not None else None
+                for r in self._call(request)["results"]]
+
+    def lookup_many(self, fingerprint, subsets=None, masks=None):
+        if masks is not None:
+            return self.request({"fingerprint": fingerprint, "masks": masks})
+        return self.request({"fingerprint": fingerprint,
+            "subsets": [list(s) for s in subsets]})
+
+    def lookup(self, fingerprint, aliases):
+        return self.lookup_many(fingerprint, subsets=[aliases])[0]
+
+    def aliases(self, fingerprint):
+        '''
+        @ret: the mask layout of the query, as CardinalityIndex.aliases.
+        '''
+        return self._call({"fingerprint": fingerprint,
+            "aliases": True})["aliases"]
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
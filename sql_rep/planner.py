@@ -0,0 +1,232 @@
+'''
+Choosing the queries that label the unknown subsets of a query.
+
+path_cover is the original strategy: cover the subset graph with chains
+(get_optimal_edges, a maximum matching per level), and run each chain as a
+left deep join order, which resolves one subset per level.
+
+bushy_cover picks join trees instead. Every internal node of a tree is a
+connected subset whose actual rows EXPLAIN ANALYZE reports, including both
+sides of a bushy join, so one execution can resolve more subsets. A join tree
+is nested pairs of aliases, e.g. (("t", "mc"), ("cn", "ct")) for
+(t CROSS JOIN mc) CROSS JOIN (cn CROSS JOIN ct).
+
+targeted_cover labels a selection of the subsets only (see
+query.compute_subsets), with as few join orders as possible.
+'''
+import itertools
+import networkx as nx
+from networkx.algorithms import bipartite
+
+from .utils import get_optimal_edges, reconstruct_paths, path_to_join_order, \
+        connected_order, tree_subsets
+
+PLANNERS = ["path", "bushy"]
+
+def path_cover(unknown_subsets):
+    '''
+    @unknown_subsets: subgraph of the subset graph with the subsets to label.
+    @ret: list of join orders (lists of alias tuples, smallest first).
+    '''
+    edges = get_optimal_edges(unknown_subsets)
+    paths = list(reconstruct_paths(edges))
+    for p in paths:
+        for el1, el2 in zip(p, p[1:]):
+            assert len(el1) > len(el2)
+
+    # ensure the paths we constructed cover every possible path
+    sanity_check_unknown_subsets = unknown_subsets.copy()
+    for n1, n2 in edges.items():
+        if n1 in sanity_check_unknown_subsets.nodes:
+            sanity_check_unknown_subsets.remove_node(n1)
+        if n2 in sanity_check_unknown_subsets.nodes:
+            sanity_check_unknown_subsets.remove_node(n2)
+
+    assert len(sanity_check_unknown_subsets.nodes) == 0
+
+    join_orders = []
+    for path in paths:
+        join_order = [tuple(sorted(x)) for x in path_to_join_order(path)]
+        join_order.reverse()
+        join_orders.append(join_order)
+    return join_orders
+
+def _chain_edges(join_graph, unknown, max_gap=2):
+    '''
+    maximum matching of parents to children: a child C of P is an unknown
+    subset P minus a connected piece of at most max_gap aliases, which the
+    tree joins as a side of P. Unlike the per level matching of
+    get_optimal_edges, a chain may skip the sizes that are already known.
+    @ret: dict from parent to child.
+    '''
+    # parents are 0..n-1 and children n..2n-1, in sorted order: the
+    # matching iterates sets of nodes, and the order of int sets, unlike
+    # that of alias tuples, doesn't change with string hash randomization
+    nodes = sorted(unknown)
+    ids = {node: i for i, node in enumerate(nodes)}
+    n = len(nodes)
+    bipart = nx.Graph()
+    bipart.add_nodes_from(range(2*n))
+    for node in nodes:
+        aliases = set(node)
+        for gap in range(1, min(max_gap, len(node) - 1) + 1):
+            for piece in itertools.combinations(node, gap):
+                if gap > 1 and not nx.is_connected(join_graph.subgraph(piece)):
+                    continue
+                child = tuple(sorted(aliases - set(piece)))
+                # unknown subsets are connected
+                if child in ids:
+                    bipart.add_edge(ids[node], n + ids[child])
+
+    matching = bipartite.hopcroft_karp_matching(bipart, range(n))
+    return {nodes[k]: nodes[v - n] for k, v in sorted(matching.items())
+            if k < n}
+
+def bushy_cover(join_graph, unknown_subsets):
+    '''
+    Chains first: _chain_edges matches every unknown subset to at most one
+    unknown child, which covers at least what the chains of path_cover do.
+    Then the roots of chains are hung under a node P of another chain when
+    the tree can join them there: either P has no child yet and P - root is
+    connected, or the root is exactly P minus P's child, so that the two
+    become the sides of a bushy join. Every matched child and hung root saves
+    a query, so this never needs more queries than path_cover. Trees whose
+    unknown subsets all end up covered by other trees are dropped at the end.
+
+    @unknown_subsets: subgraph of the subset graph with the subsets to label.
+    @ret: list of join trees.
+    '''
+    bits = {a: 1 << i for i, a in enumerate(sorted(join_graph.nodes))}
+    aliases = {bit: a for a, bit in bits.items()}
+    def _mask(node):
+        return sum(bits[a] for a in node)
+    def _aliases(mask):
+        return [a for bit, a in aliases.items() if bit & mask]
+    def _size(mask):
+        return bin(mask).count("1")
+    def _connected(mask):
+        return _size(mask) == 1 or \
+                nx.is_connected(join_graph.subgraph(_aliases(mask)))
+
+    # sorted throughout, so the trees are the same from run to run
+    unknown = sorted(set(_mask(node) for node in unknown_subsets.nodes))
+    unknown_set = set(unknown)
+    edges = _chain_edges(join_graph, sorted(unknown_subsets.nodes))
+    children = {m: [] for m in unknown}
+    parent = {}
+    for p, c in edges.items():
+        children[_mask(p)].append(_mask(c))
+        parent[_mask(c)] = _mask(p)
+
+    # the nodes a root can hang under, by the root's mask
+    complements = {}
+    childless = []
+    for p, kids in children.items():
+        if len(kids) == 1:
+            complements.setdefault(p ^ kids[0], []).append(p)
+        elif len(kids) == 0 and _size(p) > 1:
+            childless.append(p)
+
+    roots = sorted([m for m in unknown if m not in parent], key=_size,
+            reverse=True)
+    for root in roots:
+        for p in complements.get(root, []):
+            if len(children[p]) == 1 and children[p][0] == p ^ root:
+                children[p].append(root)
+                parent[root] = p
+                break
+        if root in parent:
+            continue
+        for p in childless:
+            if len(children[p]) == 0 and p & root == root and p != root \
+                    and _connected(p ^ root):
+                children[p].append(root)
+                parent[root] = p
+                complements.setdefault(p ^ root, []).append(p)
+                break
+
+    def _build(mask):
+        if _size(mask) == 1:
+            return aliases[mask]
+        kids = children.get(mask, [])
+        if len(kids) == 2:
+            a, b = kids
+        elif len(kids) == 1:
+            a = kids[0]
+            b = mask ^ a
+        else:
+            # left deep, without cross products
+            order = connected_order(join_graph, _aliases(mask))
+            a = mask ^ bits[order[-1]]
+            b = bits[order[-1]]
+        return (_build(a), _build(b))
+
+    trees = [_build(m) for m in unknown if m not in parent]
+
+    # drop the trees that only cover what the others cover too
+    covered = {}
+    tree_unknowns = []
+    for tree in trees:
+        nodes = set(s for s in tree_subsets(tree) if _mask(s) in unknown_set)
+        tree_unknowns.append(nodes)
+        for node in nodes:
+            covered[node] = covered.get(node, 0) + 1
+    kept = []
+    for i in sorted(range(len(trees)), key=lambda i: len(tree_unknowns[i])):
+        if all(covered[node] > 1 for node in tree_unknowns[i]):
+            for node in tree_unknowns[i]:
+                covered[node] -= 1
+        else:
+            kept.append(trees[i])
+    return kept
+
+def targeted_cover(join_graph, targets):
+    '''
+    Covers only the given subsets. A left deep join order can go from any
+    connected subset C to any connected superset P (adding P's aliases that
+    are adjacent to what is joined so far), so a chain may skip any number of
+    subsets in between, not just the ones of the next level. The fewest
+    chains are then a maximum matching over all pairs C < P of targets
+    (Dilworth), and the subsets the chains pass through on the way come for
+    free.
+
+    @targets: collection of connected subsets (sorted alias tuples).
+    @ret: list of join orders, as from path_cover.
+    '''
+    bits = {a: 1 << i for i, a in enumerate(sorted(join_graph.nodes))}
+    masks = {node: sum(bits[a] for a in node) for node in targets}
+    by_size = {}
+    for node in masks:
+        by_size.setdefault(len(node), []).append(node)
+
+    bipart = nx.Graph()
+    parents = [("p", node) for node in masks]
+    bipart.add_nodes_from(parents)
+    bipart.add_nodes_from(("c", node) for node in masks)
+    for node, mask in masks.items():
+        for size in range(1, len(node)):
+            for child in by_size.get(size, []):
+                if masks[child] & mask == masks[child]:
+                    bipart.add_edge(("p", node), ("c", child))
+    matching = bipartite.hopcroft_karp_matching(bipart, parents)
+    edges = {k[1]: v[1] for k, v in matching.items() if k[0] == "p"}
+
+    join_orders = []
+    children = set(edges.values())
+    for root in masks:
+        if root in children:
+            continue
+        chain = [root]
+        while chain[-1] in edges:
+            chain.append(edges[chain[-1]])
+        chain.reverse()
+        join_order = [chain[0]]
+        joined = set(chain[0])
+        for node in chain[1:]:
+            while len(joined) < len(node):
+                alias = min(a for a in node if a not in joined and
+                        any(n in joined for n in join_graph.neighbors(a)))
+                join_order.append((alias,))
+                joined.add(alias)
+        join_orders.append(join_order)
+    return join_orders
@@ -1,21 +1,49 @@
 import networkx as nx
 from .utils import *
+from .subset_cache import load_subsets, store_subsets, merge_subsets
+from .planner import path_cover, bushy_cover, targeted_cover, PLANNERS
+from .constraints import derivable_subsets
 import time
 import itertools
 import json
-import pdb
-from progressbar import progressbar as bar
 
-def get_subset_cache_name(sql):
-    return str(deterministic_hash(sql)[0:5])
+def get_subset_cache_name(fingerprint):
+    '''
+    @fingerprint: query_fingerprint of the query's join graph.
+    '''
+    return str(fingerprint[0:5])
 
 def parse_sql(sql, user, db_name, db_host, port, pwd, timeout=False,
-        compute_ground_truth=True, subset_cache_dir="./subset_cache/"):
+        compute_ground_truth=True, subset_cache_dir="./subset_cache/",
+        max_inflight=1, backend=None, materialize=False,
+        subset_cache_max_bytes=None, eviction="lru", planner="path",
+        constraints=None, verify_derived=0):
     '''
     @sql: sql query string.
+    @db_host, port: a single endpoint, or comma separated lists of replicas
+    (see replicas.parse_endpoints). The path queries are spread over all of
+    them.
+    @max_inflight: number of concurrent queries per endpoint.
+    @backend: ExecutionBackend used to count the subsets. If None, a
+    PostgresBackend is built from the connection arguments above.
+    @materialize: materialize the filtered base relations as temp tables once,
+    and run the path queries over them (see PostgresBackend).
+    @subset_cache_max_bytes: size cap of subset_cache_dir; other entries are
+    evicted by the eviction policy ("lru" or "cost") when it is exceeded.
+    @planner: "path" runs a left deep join order per chain of the path cover,
+    "bushy" runs the join trees of planner.bushy_cover, which need at most as
+    many queries.
+    @constraints: KeyConstraints. The subsets whose cardinality follows from
+    them (see constraints.derivable_subsets) are not executed but filled in
+    from smaller subsets; their estimates come from a plain EXPLAIN (None if
+    the backend has no estimates), and they are marked with "derived".
+    @verify_derived: number of derived subsets, picked at random, that are
+    also counted directly to check the constraints hold.
 
     @ret: python dict with the keys:
         sql: original sql string
+        fingerprint: query_fingerprint of the join graph, the key of the
+        query in the subset cache.
         join_graph: networkX graph representing query and its
         join_edges. Properties include:
             Nodes:
@@ -48,8 +76,11 @@ def parse_sql(sql, user, db_name, db_host, port, pwd, timeout=False,
           len(subset_graph), " possible subsets.",
           "took:", time.time() - start)
 
+    fingerprint = query_fingerprint(join_graph)
+
     ret = {}
     ret["sql"] = sql
+    ret["fingerprint"] = fingerprint
     ret["join_graph"] = join_graph
     ret["subset_graph"] = subset_graph
 
@@ -58,17 +89,29 @@ def parse_sql(sql, user, db_name, db_host, port, pwd, timeout=False,
         ret["subset_graph"] = nx.adjacency_data(ret["subset_graph"])
         return ret
 
-    assert user is not None
+    # only imported once we actually need to execute something, so parse-only
+    # users don't pay for them
+    from progressbar import progressbar as bar
+    from .backends import PostgresBackend
+
+    if backend is None:
+        assert user is not None
+        backend = PostgresBackend(user, db_host, port, pwd, db_name,
+                timeout=timeout, max_inflight=max_inflight,
+                compute_ground_truth=compute_ground_truth,
+                materialize=materialize)
+
     make_dir(subset_cache_dir)
-    subset_cache_file = subset_cache_dir + get_subset_cache_name(sql)
+    subset_cache_name = get_subset_cache_name(fingerprint)
     # we should check and see which cardinalities of the subset graph
     # we already know. Note thate we have to cache at this level because
     # the maximal matching might make arbitrary choices each time.
-    with shelve.open(subset_cache_file) as cache:
-        if sql in cache:
-            currently_stored = cache[sql]
-        else:
-            currently_stored = {}
+    currently_stored = load_subsets(subset_cache_dir, subset_cache_name,
+            fingerprint)
+    if len(currently_stored) == 0:
+        # entries cached before fingerprinting were keyed by the raw sql
+        currently_stored = load_subsets(subset_cache_dir,
+                str(deterministic_hash(sql)[0:5]), sql, track=False)
 
     unknown_subsets = subset_graph.copy()
     unknown_subsets = unknown_subsets.subgraph(subset_graph.nodes - currently_stored.keys())
@@ -76,85 +119,93 @@ def parse_sql(sql, user, db_name, db_host, port, pwd, timeout=False,
     print(len(unknown_subsets.nodes), "/", len(subset_graph.nodes), "subsets still unknown (",
           len(currently_stored), "known )")
 
+    derived = {}
+    if constraints is not None:
+        derived = {node: source for node, source in derivable_subsets(
+            join_graph, subset_graph, constraints).items()
+            if node in unknown_subsets.nodes}
+        unknown_subsets = subset_graph.subgraph(unknown_subsets.nodes -
+                derived.keys())
+        print(len(derived), "of them follow from key constraints")
 
-    # let us update the ground truth values
-    edges = get_optimal_edges(unknown_subsets)
-    paths = list(reconstruct_paths(edges))
-    for p in paths:
-        for el1, el2 in zip(p, p[1:]):
-            assert len(el1) > len(el2)
 
-    # ensure the paths we constructed cover every possible path
+    assert planner in PLANNERS, "unknown planner {}".format(planner)
     sanity_check_unknown_subsets = unknown_subsets.copy()
-    for n1, n2 in edges.items():
-        if n1 in sanity_check_unknown_subsets.nodes:
-            sanity_check_unknown_subsets.remove_node(n1)
-        if n2 in sanity_check_unknown_subsets.nodes:
-            sanity_check_unknown_subsets.remove_node(n2)
-
-    assert len(sanity_check_unknown_subsets.nodes) == 0
-
-    subset_sqls = []
-
-    for path in paths:
-        join_order = [tuple(sorted(x)) for x in path_to_join_order(path)]
-        join_order.reverse()
-        sql_to_exec = nodes_to_sql(join_order, join_graph)
-        if compute_ground_truth:
-            prefix = "explain (analyze, timing off, format json) "
-        else:
-            prefix = "explain (analyze off, timing off, format json) "
-        sql_to_exec = prefix + sql_to_exec
-        subset_sqls.append(sql_to_exec)
-
-    print("computing all", len(unknown_subsets), "unknown subset cardinalities with"
-          , len(subset_sqls), "queries")
-
-    pre_exec_sqls = []
-
-    # TODO: if we use the min #queries approach, maybe greedy approach and
-    # letting pg choose join order is better?
-    pre_exec_sqls.append("set join_collapse_limit to 1")
-    pre_exec_sqls.append("set from_collapse_limit to 1")
-    if timeout:
-        pre_exec_sqls.append("set statement_timeout = {}".format(timeout))
-
-    sanity_check_unknown_subsets = unknown_subsets.copy()
-    for idx, path_sql in enumerate(bar(subset_sqls)):
-        res = execute_query(path_sql, user, db_host, port, pwd, db_name,
-                            pre_exec_sqls)
-        if res is None:
-            print("Query failed to execute, ignoring.")
-            breakpoint()
-            continue
-
-        plan = res[0][0][0]
-        plan_tree = plan["Plan"]
-        results = list(analyze_plan(plan_tree))
-        for result in results:
-            # this assertion is invalid because PG may choose to use an implicit join predicate,
-            # for example, if a.c1 = b.c1 and b.c1 = c.c1, then PG may choose to join on a.c1 = c.c1
-            # assert nx.is_connected(join_graph.subgraph(result["aliases"])), (result["aliases"], plan_tree)
-            aliases_key = tuple(sorted(result["aliases"]))
-            if compute_ground_truth:
-                currently_stored[aliases_key] = {"expected": result["expected"],
-                                                 "actual": result["actual"]}
-            else:
-                currently_stored[aliases_key] = {"expected": result["expected"]}
-
-            if aliases_key in sanity_check_unknown_subsets.nodes:
-                sanity_check_unknown_subsets.remove_node(aliases_key)
-
-        if idx % 5 == 0:
-            with shelve.open(subset_cache_file) as cache:
-                cache[sql] = currently_stored
-
+    last_stored = time.time()
+
+    def _collect(results_iter, num_queries):
+        nonlocal last_stored
+        for idx, (_, results) in enumerate(bar(results_iter, max_value=num_queries)):
+            if results is None:
+                print("Query failed to execute, ignoring.")
+                continue
+
+            for result in results:
+                # this assertion is invalid because PG may choose to use an implicit join predicate,
+                # for example, if a.c1 = b.c1 and b.c1 = c.c1, then PG may choose to join on a.c1 = c.c1
+                # assert nx.is_connected(join_graph.subgraph(result["aliases"])), (result["aliases"], plan_tree)
+                aliases_key = tuple(sorted(result["aliases"]))
+                # local backends only know the true counts
+                currently_stored[aliases_key] = {k: v for k, v in result.items()
+                        if k in ("expected", "actual")}
+
+                if aliases_key in sanity_check_unknown_subsets.nodes:
+                    sanity_check_unknown_subsets.remove_node(aliases_key)
+
+            if idx % 5 == 0:
+                store_subsets(subset_cache_dir, subset_cache_name, fingerprint,
+                        currently_stored, cost=time.time()-last_stored,
+                        aliases=join_graph.nodes)
+                last_stored = time.time()
+
+    if planner == "bushy":
+        trees = bushy_cover(join_graph, unknown_subsets)
+        print("computing all", len(unknown_subsets), "unknown subset cardinalities with"
+              , len(trees), "join trees")
+        _collect(backend.map_join_trees(join_graph, trees), len(trees))
+        # joins on the inner side of a nested loop only report per loop
+        # rows, so the trees may have missed some subsets
+        unknown_subsets = subset_graph.subgraph(
+                sanity_check_unknown_subsets.nodes)
+        if len(unknown_subsets) > 0:
+            print(len(unknown_subsets), "subsets left after the join trees")
+
+    if planner == "path" or len(unknown_subsets) > 0:
+        join_orders = path_cover(unknown_subsets)
+        print("computing all", len(unknown_subsets), "unknown subset cardinalities with"
+              , len(join_orders), "queries")
+        _collect(backend.map_join_orders(join_graph, join_orders),
+                len(join_orders))
+
+    if isinstance(backend, PostgresBackend) and len(backend.pool.endpoints) > 1:
+        print("queries per endpoint:", backend.pool.summary())
     print(len(currently_stored), "total subsets now known")
 
     assert len(sanity_check_unknown_subsets.nodes) == 0
 
-    with shelve.open(subset_cache_file) as cache:
-        cache[sql] = currently_stored
+    # smallest first, so that derived sources are filled in before use
+    missing = [node for node in sorted(derived, key=len)
+            if node not in currently_stored]
+    for node in missing:
+        currently_stored[node] = {"actual":
+                currently_stored[derived[node]]["actual"],
+                "expected": None, "derived": True}
+    for i, expected in backend.map_estimates(join_graph, missing):
+        currently_stored[missing[i]]["expected"] = expected
+
+    if verify_derived > 0 and len(missing) > 0:
+        import random
+        for node in random.sample(missing, min(verify_derived, len(missing))):
+            actual = backend.count(join_graph, node)
+            assert actual == currently_stored[node]["actual"], \
+                "{} has {} rows, but was derived as {} from {}".format(node,
+                    actual, currently_stored[node]["actual"], derived[node])
+        print("verified", min(verify_derived, len(missing)), "derived subsets")
+
+    store_subsets(subset_cache_dir, subset_cache_name, fingerprint,
+            currently_stored,
+            cost=time.time()-last_stored, max_bytes=subset_cache_max_bytes,
+            policy=eviction, aliases=join_graph.nodes)
 
     for node in subset_graph.nodes:
         subset_graph.nodes[node]["cardinality"] = currently_stored[node]
@@ -167,3 +218,71 @@ def parse_sql(sql, user, db_name, db_host, port, pwd, timeout=False,
 
     return ret
 
+def compute_subsets(sql, backend, subsets=None, max_size=None, contains=None,
+        selector=None, subset_cache_dir="./subset_cache/",
+        subset_cache_max_bytes=None, eviction="lru"):
+    '''
+    like parse_sql, but only labels the selected subsets: the cached ones are
+    looked up, and the rest are covered with planner.targeted_cover, so the
+    cost depends on the selection rather than the whole subset graph.
+
+    @backend: ExecutionBackend the join orders are executed on.
+    @subsets: explicit list of alias collections to label; they must be
+    connected in the join graph. Otherwise, the connected subsets are
+    selected by:
+    @max_size: at most this many aliases.
+    @contains: an alias, or a collection of aliases, every subset contains.
+    @selector: function from a sorted alias tuple to True if it is needed.
+    @subset_cache_max_bytes, eviction: as in parse_sql.
+
+    @ret: dict from the selected subsets (sorted alias tuples) to their
+    {"actual": .., "expected": ..}, or None if its query failed. Everything
+    the join orders computed, including subsets that weren't selected, is
+    merged into the subset cache.
+    '''
+    start = time.time()
+    join_graph = extract_join_graph(sql)
+    fingerprint = query_fingerprint(join_graph)
+    if subsets is not None:
+        targets = set(tuple(sorted(s)) for s in subsets)
+        for target in targets:
+            assert nx.is_connected(join_graph.subgraph(target)), \
+                    "{} is not connected".format(target)
+    else:
+        if isinstance(contains, str):
+            contains = [contains]
+        targets = set()
+        for node in connected_subgraphs(join_graph, max_size=max_size):
+            if contains is not None and not set(contains) <= set(node):
+                continue
+            if selector is not None and not selector(node):
+                continue
+            targets.add(node)
+
+    make_dir(subset_cache_dir)
+    subset_cache_name = get_subset_cache_name(fingerprint)
+    stored = load_subsets(subset_cache_dir, subset_cache_name, fingerprint)
+    unknown = [t for t in targets if t not in stored]
+    join_orders = targeted_cover(join_graph, unknown)
+    print(len(targets), "subsets selected,", len(unknown), "unknown, computed "
+          "with", len(join_orders), "queries")
+
+    computed = {}
+    last_stored = time.time()
+    for idx, (_, results) in enumerate(backend.map_join_orders(join_graph,
+            join_orders)):
+        if results is None:
+            print("Query failed to execute, ignoring.")
+        for result in results or []:
+            computed[tuple(sorted(result["aliases"]))] = {k: v for k, v in
+                    result.items() if k in ("expected", "actual")}
+        if idx % 5 == 4 or idx == len(join_orders) - 1:
+            stored = merge_subsets(subset_cache_dir, subset_cache_name,
+                    fingerprint, computed, cost=time.time()-last_stored,
+                    max_bytes=subset_cache_max_bytes, policy=eviction,
+                    aliases=join_graph.nodes)
+            computed = {}
+            last_stored = time.time()
+
+    print("total time:", time.time() - start)
+    return {target: stored.get(target) for target in targets}
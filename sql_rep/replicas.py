@@ -0,0 +1,237 @@
+'''
+Spreads the path queries of a labeling run over several read-only replicas of
+the same database. Every replica is an endpoint (host, port); at most
+max_inflight queries run on an endpoint at a time, new queries go to the
+endpoint with the least expected wait, and a query that can't reach one
+replica is retried on the others.
+'''
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .utils import execute_query
+
+def _connection_error(e):
+    '''
+    @ret: True if e means the endpoint is unreachable or dropped the
+    connection, rather than that the query itself is wrong.
+    '''
+    import psycopg2 as pg
+    if isinstance(e, pg.extensions.QueryCanceledError):
+        return False
+    return isinstance(e, (pg.OperationalError, pg.InterfaceError))
+
+def parse_endpoints(db_host, port):
+    '''
+    @db_host: hostname, comma separated string of hostnames, or list.
+    @port: port, comma separated string of ports, or list.
+
+    If one side has a single entry, it is used for every entry on the other
+    side, so "localhost" with "5432,5433,5434" gives three local endpoints.
+
+    @ret: list of (host, port) tuples.
+    '''
+    def _split(val):
+        if isinstance(val, (list, tuple)):
+            return [str(v).strip() for v in val]
+        return [v.strip() for v in str(val).split(",") if v.strip()]
+
+    hosts = _split(db_host)
+    ports = _split(port)
+    assert len(hosts) > 0 and len(ports) > 0
+    if len(hosts) == 1:
+        hosts = hosts * len(ports)
+    if len(ports) == 1:
+        ports = ports * len(hosts)
+    assert len(hosts) == len(ports), "need as many ports as hosts"
+
+    return list(zip(hosts, ports))
+
+class ReplicaPool():
+    '''
+    Load aware dispatch of queries over a list of endpoints.
+
+    Each endpoint keeps a moving average of its query latency; a query is
+    sent to the endpoint minimizing (inflight + 1) * avg_latency among those
+    below their in-flight limit. After max_failures consecutive errors an
+    endpoint is benched for cooldown seconds.
+    '''
+    def __init__(self, endpoints, user, pwd, db_name, max_inflight=1,
+            max_failures=3, cooldown=30.0):
+        self.endpoints = list(endpoints)
+        self.user = user
+        self.pwd = pwd
+        self.db_name = db_name
+        self.max_inflight = max_inflight
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+
+        self.inflight = [0]*len(self.endpoints)
+        # unknown latencies start equal, so the first queries round robin
+        self.latency = [1.0]*len(self.endpoints)
+        self.failures = [0]*len(self.endpoints)
+        self.benched_until = [0.0]*len(self.endpoints)
+        self.executed = [0]*len(self.endpoints)
+        self.cv = threading.Condition()
+        # (endpoint index, session key) -> idle connections of that session
+        self.session_cons = {}
+
+    def capacity(self):
+        return self.max_inflight * len(self.endpoints)
+
+    def _acquire(self, exclude):
+        '''
+        blocks till some endpoint not in exclude has a free slot.
+        @ret: endpoint index, or None if every endpoint is excluded.
+        '''
+        with self.cv:
+            while True:
+                candidates = [i for i in range(len(self.endpoints))
+                        if i not in exclude]
+                if len(candidates) == 0:
+                    return None
+
+                now = time.time()
+                live = [i for i in candidates if self.benched_until[i] <= now]
+                if len(live) == 0:
+                    # everyone is benched, so just use whoever comes back
+                    # first rather than failing the query outright.
+                    live = [min(candidates, key=lambda i: self.benched_until[i])]
+
+                free = [i for i in live if self.inflight[i] < self.max_inflight]
+                if len(free) > 0:
+                    best = min(free, key=lambda i:
+                            (self.inflight[i]+1)*self.latency[i])
+                    self.inflight[best] += 1
+                    return best
+                self.cv.wait(timeout=1.0)
+
+    def _release(self, idx, latency, failed):
+        with self.cv:
+            self.inflight[idx] -= 1
+            if failed:
+                self.failures[idx] += 1
+                if self.failures[idx] >= self.max_failures:
+                    print("benching endpoint", self.endpoints[idx], "for",
+                          self.cooldown, "seconds")
+                    self.benched_until[idx] = time.time() + self.cooldown
+                    self.failures[idx] = 0
+            else:
+                self.failures[idx] = 0
+                self.executed[idx] += 1
+                self.latency[idx] = 0.8*self.latency[idx] + 0.2*latency
+            self.cv.notify_all()
+
+    def _session_connection(self, idx, session):
+        key, setup_sqls = session
+        with self.cv:
+            idle = self.session_cons.get((idx, key), [])
+            if len(idle) > 0:
+                return idle.pop()
+        import psycopg2 as pg
+        host, port = self.endpoints[idx]
+        con = pg.connect(user=self.user, host=host, port=port,
+                password=self.pwd, database=self.db_name)
+        # temp tables have to outlive the transaction
+        con.autocommit = True
+        try:
+            cursor = con.cursor()
+            for setup_sql in setup_sqls:
+                cursor.execute(setup_sql)
+            cursor.close()
+        except:
+            con.close()
+            raise
+        return con
+
+    def _execute_in_session(self, idx, sql, pre_execs, session):
+        '''
+        like execute_query, but on a kept open connection of the session.
+        '''
+        con = self._session_connection(idx, session)
+        try:
+            cursor = con.cursor()
+            for setup_sql in pre_execs:
+                cursor.execute(setup_sql)
+            cursor.execute(sql)
+            exp_output = cursor.fetchall()
+            cursor.close()
+        except Exception as e:
+            print(e)
+            con.close()
+            if not "timeout" in str(e):
+                return e
+            return "timeout"
+
+        with self.cv:
+            self.session_cons.setdefault((idx, session[0]), []).append(con)
+        return exp_output
+
+    def close_session(self, key, cleanup_sqls=[]):
+        '''
+        runs cleanup_sqls on, and closes, every connection of the session.
+        '''
+        with self.cv:
+            keys = [k for k in self.session_cons if k[1] == key]
+            cons = []
+            for k in keys:
+                cons += self.session_cons.pop(k)
+        for con in cons:
+            try:
+                cursor = con.cursor()
+                for cleanup_sql in cleanup_sqls:
+                    cursor.execute(cleanup_sql)
+                cursor.close()
+            finally:
+                con.close()
+
+    def execute(self, sql, pre_execs, session=None):
+        '''
+        executes sql on some endpoint, failing over to the others on
+        connection errors, which also count towards benching the endpoint.
+        Errors of the query itself (and timeouts) are returned right away,
+        since the other replicas hold the same data.
+        @session: None, or (key, setup_sqls). The query then runs on a kept
+        open connection that has already executed setup_sqls (e.g. to create
+        temp tables), see close_session.
+        @ret: same as execute_query.
+        '''
+        tried = set()
+        res = None
+        while True:
+            idx = self._acquire(tried)
+            if idx is None:
+                return res
+            host, port = self.endpoints[idx]
+            start = time.time()
+            try:
+                if session is None:
+                    res = execute_query(sql, self.user, host, port, self.pwd,
+                            self.db_name, pre_execs)
+                else:
+                    res = self._execute_in_session(idx, sql, pre_execs, session)
+            except Exception as e:
+                # connection failures are raised, not returned
+                res = e
+            failed = isinstance(res, Exception) and _connection_error(res)
+            self._release(idx, time.time() - start, failed)
+            if not failed:
+                return res
+            print("endpoint {}:{} failed, trying another replica".format(
+                host, port))
+            tried.add(idx)
+
+    def map(self, sqls, pre_execs, session=None):
+        '''
+        @ret: generator over (index into sqls, result) in completion order.
+        '''
+        with ThreadPoolExecutor(max_workers=self.capacity()) as executor:
+            futures = {executor.submit(self.execute, sql, pre_execs,
+                    session): i
+                    for i, sql in enumerate(sqls)}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def summary(self):
+        return {"{}:{}".format(h, p): n for (h, p), n in
+                zip(self.endpoints, self.executed)}
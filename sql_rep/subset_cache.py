@@ -0,0 +1,343 @@
+'''
+Management of the subset cache directory used by parse_sql.
+
+Every cache entry is a shelve file (named by get_subset_cache_name) mapping
+a query key to its dict of known subset cardinalities. Next to the entries,
+index.json keeps per entry bookkeeping: last access time, the seconds spent
+computing its subsets (its recomputation cost), size, and hit / miss counts,
+which the size cap and eviction use. It also keeps the sorted aliases of
+every stored query key (under "queries"), since a partially labeled entry
+doesn't have all of them in its subsets.
+'''
+import fcntl
+import glob
+import json
+import os
+import time
+from contextlib import contextmanager
+
+INDEX_FILE = "index.json"
+LOCK_FILE = ".lock"
+EVICTION_POLICIES = ["lru", "cost"]
+
+@contextmanager
+def _locked_index(cache_dir):
+    '''
+    yields the index dict under an exclusive lock, and writes it back.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, LOCK_FILE), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            fn = os.path.join(cache_dir, INDEX_FILE)
+            if os.path.exists(fn):
+                with open(fn, "r") as f:
+                    index = json.load(f)
+            else:
+                index = {"entries": {}, "hits": 0, "misses": 0}
+            yield index
+            tmp_fn = fn + ".tmp"
+            with open(tmp_fn, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_fn, fn)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def _new_entry():
+    return {"cost": 0.0, "hits": 0, "misses": 0, "bytes": 0, "subsets": 0,
+            "last_access": 0.0}
+
+def _entry_files(cache_dir, name):
+    # depending on the dbm backend, a shelve is one or several files
+    # (name, name.db, name.dat / .dir / .bak)
+    return [fn for fn in glob.glob(os.path.join(cache_dir, name + "*"))
+            if os.path.basename(fn) == name or
+            os.path.basename(fn)[len(name)] == "."]
+
+def _entry_bytes(cache_dir, name):
+    return sum(os.path.getsize(fn) for fn in _entry_files(cache_dir, name))
+
+def _entry_file_map(cache_dir):
+    '''
+    like _entry_files for every entry, but listing the directory once.
+    @ret: dict from entry name to its files.
+    '''
+    files = {}
+    for fn in os.listdir(cache_dir):
+        if fn in (INDEX_FILE, LOCK_FILE) or fn.startswith(INDEX_FILE):
+            continue
+        files.setdefault(fn.split(".")[0], []).append(
+                os.path.join(cache_dir, fn))
+    return files
+
+def _files_bytes(files):
+    return sum(os.path.getsize(fn) for fn in files)
+
+def _remove_entry(cache_dir, name, index, files=None):
+    '''
+    @files: the entry's files, if already known (see _entry_file_map).
+    '''
+    if files is None:
+        files = _entry_files(cache_dir, name)
+    for fn in files:
+        os.remove(fn)
+    index["entries"].pop(name, None)
+    queries = index.get("queries", {})
+    for key in [k for k, q in queries.items() if q["name"] == name]:
+        queries.pop(key)
+
+def load_subsets(cache_dir, name, key, track=True):
+    '''
+    @track: count the lookup in the hit / miss stats.
+    @ret: the stored dict of subset cardinalities of key, or {}.
+    '''
+    import shelve
+    with _locked_index(cache_dir) as index:
+        if len(_entry_files(cache_dir, name)) == 0:
+            # don't leave empty shelves behind for misses
+            stored = {}
+        else:
+            with shelve.open(os.path.join(cache_dir, name), "r") as cache:
+                stored = cache[key] if key in cache else {}
+
+        if not track:
+            return stored
+        entry = index["entries"].setdefault(name, _new_entry())
+        entry["last_access"] = time.time()
+        if len(stored) > 0:
+            entry["hits"] += 1
+            index["hits"] += 1
+        else:
+            entry["misses"] += 1
+            index["misses"] += 1
+    return stored
+
+def store_subsets(cache_dir, name, key, subsets, cost=0.0, max_bytes=None,
+        policy="lru", aliases=None):
+    '''
+    @cost: seconds spent computing the subsets added since the last store;
+    accumulated as the entry's recomputation cost.
+    @max_bytes: if given, evict other entries till the cache fits.
+    @aliases: all the aliases of the query, kept in the index (see
+    query_aliases).
+    '''
+    with _locked_index(cache_dir) as index:
+        _store(cache_dir, index, name, key, subsets, cost, max_bytes, policy,
+                aliases)
+
+def merge_subsets(cache_dir, name, key, subsets, cost=0.0, max_bytes=None,
+        policy="lru", aliases=None):
+    '''
+    like store_subsets, but adds subsets to the ones already stored for key
+    while holding the lock, so that several workers (see workqueue) writing
+    to the same entry don't lose each other's results.
+    @ret: the merged dict.
+    '''
+    import shelve
+    with _locked_index(cache_dir) as index:
+        merged = {}
+        if len(_entry_files(cache_dir, name)) > 0:
+            with shelve.open(os.path.join(cache_dir, name), "r") as cache:
+                if key in cache:
+                    merged = cache[key]
+        merged.update(subsets)
+        _store(cache_dir, index, name, key, merged, cost, max_bytes, policy,
+                aliases)
+    return merged
+
+def _store(cache_dir, index, name, key, subsets, cost, max_bytes, policy,
+        aliases=None):
+    import shelve
+    with shelve.open(os.path.join(cache_dir, name)) as cache:
+        cache[key] = subsets
+    if aliases is not None:
+        index.setdefault("queries", {})[key] = {"name": name,
+                "aliases": sorted(aliases)}
+
+    entry = index["entries"].setdefault(name, _new_entry())
+    entry["last_access"] = time.time()
+    entry["cost"] += cost
+    entry["bytes"] = _entry_bytes(cache_dir, name)
+    entry["subsets"] = len(subsets)
+
+    if max_bytes is not None:
+        _evict(cache_dir, index, max_bytes, policy, keep=[name])
+
+def _sync_index(cache_dir, index, files=None):
+    '''
+    adds the entries written before there was an index, using their
+    modification time as last access, and drops the ones deleted by hand.
+    @files: _entry_file_map(cache_dir), if already listed.
+    '''
+    if files is None:
+        files = _entry_file_map(cache_dir)
+    names = set(files)
+    for name in names:
+        if name not in index["entries"]:
+            entry = _new_entry()
+            entry["bytes"] = _files_bytes(files[name])
+            entry["last_access"] = max(os.path.getmtime(fn) for fn in
+                    files[name])
+            index["entries"][name] = entry
+    for name in set(index["entries"]) - set(names):
+        index["entries"].pop(name)
+    queries = index.get("queries", {})
+    for key in [k for k, q in queries.items() if q["name"] not in names]:
+        queries.pop(key)
+
+def _evict(cache_dir, index, max_bytes, policy, keep=[]):
+    assert policy in EVICTION_POLICIES
+    files = _entry_file_map(cache_dir)
+    _sync_index(cache_dir, index, files)
+    total = sum(e["bytes"] for e in index["entries"].values())
+    if total <= max_bytes:
+        return []
+
+    if policy == "lru":
+        key = lambda name: index["entries"][name]["last_access"]
+    else:
+        # cheapest to recompute per byte freed goes first
+        key = lambda name: index["entries"][name]["cost"] / \
+                max(index["entries"][name]["bytes"], 1)
+    candidates = sorted([n for n in index["entries"] if n not in keep], key=key)
+
+    evicted = []
+    for name in candidates:
+        if total <= max_bytes:
+            break
+        total -= index["entries"][name]["bytes"]
+        _remove_entry(cache_dir, name, index, files.get(name, []))
+        evicted.append(name)
+    return evicted
+
+def evict_cache(cache_dir, max_bytes, policy="lru"):
+    '''
+    @policy: lru evicts the least recently accessed entries first, cost the
+    ones with the lowest recomputation cost per byte.
+    @ret: names of the evicted entries.
+    '''
+    with _locked_index(cache_dir) as index:
+        return _evict(cache_dir, index, max_bytes, policy)
+
+def compact_cache(cache_dir):
+    '''
+    Rewrites every entry into a fresh shelve. dbm files never give back the
+    space of overwritten values, and parse_sql rewrites the whole dict at
+    every checkpoint, so they bloat over time.
+    @ret: (bytes before, bytes after).
+    '''
+    import shelve
+    before = 0
+    after = 0
+    with _locked_index(cache_dir) as index:
+        files = _entry_file_map(cache_dir)
+        for name in sorted(files):
+            before += _files_bytes(files[name])
+            with shelve.open(os.path.join(cache_dir, name), "r") as cache:
+                data = dict(cache.items())
+            for fn in files[name]:
+                os.remove(fn)
+            with shelve.open(os.path.join(cache_dir, name), "n") as cache:
+                cache.update(data)
+        # the new files, in one more listing
+        files = _entry_file_map(cache_dir)
+        for name in files:
+            size = _files_bytes(files[name])
+            after += size
+            index["entries"].setdefault(name, _new_entry())["bytes"] = size
+    return before, after
+
+def _entry_names(cache_dir):
+    return sorted(_entry_file_map(cache_dir))
+
+@contextmanager
+def _shared_lock(cache_dir):
+    '''
+    holds a shared lock on the cache, for readers: writers wait, other
+    readers don't, and the directory need not be writable.
+    '''
+    fn = os.path.join(cache_dir, LOCK_FILE)
+    if not os.path.exists(fn):
+        # nothing was ever written under the lock
+        yield
+        return
+    with open(fn, "r") as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def read_entries(cache_dir):
+    '''
+    reads every entry under a shared lock, without touching the index.
+    @ret: list of (name, key, dict of subset cardinalities).
+    '''
+    import shelve
+    entries = []
+    if not os.path.exists(cache_dir):
+        return entries
+    with _shared_lock(cache_dir):
+        for name in _entry_names(cache_dir):
+            with shelve.open(os.path.join(cache_dir, name), "r") as cache:
+                for key in cache.keys():
+                    entries.append((name, key, cache[key]))
+    return entries
+
+def query_aliases(cache_dir):
+    '''
+    @ret: dict from query key to the sorted aliases of the query, for the
+    keys stored with their aliases.
+    '''
+    fn = os.path.join(cache_dir, INDEX_FILE)
+    if not os.path.exists(fn):
+        return {}
+    with _shared_lock(cache_dir):
+        with open(fn, "r") as f:
+            index = json.load(f)
+    return {key: q["aliases"] for key, q in index.get("queries", {}).items()}
+
+def cache_version(cache_dir):
+    '''
+    @ret: a value that changes whenever an entry is written (the latest
+    modification time and number of the entry files).
+    '''
+    if not os.path.exists(cache_dir):
+        return None
+    latest = 0.0
+    num_files = 0
+    # a single pass over the directory, this runs inline in the lookup
+    # servers' request handlers
+    with os.scandir(cache_dir) as it:
+        for f in it:
+            if f.name in (INDEX_FILE, LOCK_FILE) or \
+                    f.name.startswith(INDEX_FILE):
+                continue
+            try:
+                latest = max(latest, f.stat().st_mtime)
+            except FileNotFoundError:
+                # evicted meanwhile
+                continue
+            num_files += 1
+    return (latest, num_files)
+
+def cache_stats(cache_dir):
+    '''
+    @ret: dict with the number of entries, subsets, bytes on disk, hits,
+    misses and hit rate of the cache.
+    '''
+    with _locked_index(cache_dir) as index:
+        files = _entry_file_map(cache_dir)
+        _sync_index(cache_dir, index, files)
+        names = list(index["entries"])
+        num_bytes = sum(_files_bytes(files[n]) for n in names)
+        subsets = sum(index["entries"][n]["subsets"] for n in names)
+        hits = index["hits"]
+        misses = index["misses"]
+
+    return {"entries": len(names),
+            "subsets": subsets,
+            "bytes": num_bytes,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses > 0 else 0.0}
@@ -1,20 +1,20 @@
-import sqlparse
-from sqlparse.sql import IdentifierList, Identifier
-from sqlparse.tokens import Keyword, DML
-from moz_sql_parser import parse
+'''
+Only networkx and the standard library are imported up front, so that
+parsing and subset enumeration stay cheap to import; sqlparse (the fallback
+parser), moz_sql_parser, psycopg2 and graphviz are imported by the functions
+that need them.
+'''
 import time
-from networkx.drawing.nx_agraph import graphviz_layout, to_agraph
 from networkx.algorithms import bipartite
 import networkx as nx
 import itertools
 import hashlib
-import psycopg2 as pg
-import shelve
-import pdb
+import json
 import os
 import errno
+import re
 
-import getpass
+from .fast_parser import parse_conjunctive, UnsupportedQuery
 
 ALIAS_FORMAT = "{TABLE} AS {ALIAS}"
 RANGE_PREDS = ["gt", "gte", "lt", "lte"]
@@ -24,17 +24,22 @@ COUNT_SIZE_TEMPLATE = "SELECT COUNT(*) FROM {FROM_CLAUSE}"
 functions copied over from ryan's utils files
 '''
 
-def connected_subgraphs(g):
+def connected_subgraphs(g, max_size=None):
+    '''
+    @max_size: only the subgraphs of at most this many nodes.
+    '''
+    if max_size is None:
+        max_size = len(g)
     # for i in range(2, len(g)+1):
-    for i in range(1, len(g)+1):
+    for i in range(1, min(max_size, len(g))+1):
         for nodes_in_sg in itertools.combinations(g.nodes, i):
             sg = g.subgraph(nodes_in_sg)
             if nx.is_connected(sg):
                 yield tuple(sorted(sg.nodes))
 
-def generate_subset_graph(g):
+def generate_subset_graph(g, max_size=None):
     subset_graph = nx.DiGraph()
-    for csg in connected_subgraphs(g):
+    for csg in connected_subgraphs(g, max_size=max_size):
         subset_graph.add_node(csg)
 
     # print(subset_graph.nodes)
@@ -124,6 +129,8 @@ def reconstruct_paths(edges):
     return paths
 
 def greedy(subset_graph, plot=False):
+    if plot:
+        from networkx.drawing.nx_agraph import graphviz_layout, to_agraph
     subset_graph = subset_graph.copy()
 
     while subset_graph:
@@ -141,7 +148,26 @@ def path_to_join_order(path):
         remaining -= diff
     yield remaining
 
-def order_to_from_clause(join_graph, join_order, alias_mapping):
+def connected_order(join_graph, aliases):
+    '''
+    @ret: the aliases in an order where every prefix is connected in
+    join_graph, i.e., a left deep join order without cross products.
+    '''
+    aliases = set(aliases)
+    order = [min(aliases)]
+    while len(order) < len(aliases):
+        frontier = {n for a in order for n in join_graph.neighbors(a)
+                if n in aliases} - set(order)
+        assert len(frontier) > 0, "aliases are not connected"
+        order.append(min(frontier))
+    return order
+
+def order_to_from_clause(join_graph, join_order, alias_mapping, explain=None):
+    '''
+    @explain: function from a sql string to its postgres json explain output
+    (as fetched by cursor.fetchall()). Only needed when the first element of
+    join_order has more than one relation.
+    '''
     clauses = []
     for rels in join_order:
         if len(rels) > 1:
@@ -150,16 +176,9 @@ def order_to_from_clause(join_graph, join_order, alias_mapping):
             # bottom-level joins.
             sg = join_graph.subgraph(rels)
             sql = nx_graph_to_query(sg)
-            # con = pg.connect(user="ubuntu", host="localhost", database="imdb")
-            con = pg.connect(user="pari", host="localhost", database="imdb",
-                   port=5433)
-            cursor = con.cursor()
-            # cursor.execute(f"explain (format json) {sql}")
-            cursor.execute("explain (format json) {}".format(sql))
-            explain = cursor.fetchall()
-            cursor.close()
-            con.close()
-            pg_order,_,_ = get_pg_join_order(join_graph, explain)
+            assert explain is not None, "need postgres to order {}".format(rels)
+            explain_output = explain(sql)
+            pg_order,_,_ = get_pg_join_order(join_graph, explain_output)
             assert not clauses
             clauses.append(pg_order)
             continue
@@ -190,7 +209,11 @@ def extract_aliases(plan, jg=None):
     for subplan in plan["Plans"]:
         yield from extract_aliases(subplan, jg=jg)
 
-def analyze_plan(plan):
+def analyze_plan(plan, analyze=True):
+    '''
+    @analyze: False if plan comes from a plain EXPLAIN, so it only has the
+    estimates.
+    '''
     if plan["Node Type"] in join_types:
         aliases = extract_aliases(plan)
         data = {"aliases": list(sorted(aliases))}
@@ -198,9 +221,9 @@ def analyze_plan(plan):
             data["expected"] = plan["Plan Rows"]
         if "Actual Rows" in plan:
             data["actual"] = plan["Actual Rows"]
-        else:
+        elif analyze:
             print("Actual Rows not in plan!")
-            pdb.set_trace()
+            breakpoint()
 
         yield data
 
@@ -208,19 +231,38 @@ def analyze_plan(plan):
         return
 
     for subplan in plan["Plans"]:
-        yield from analyze_plan(subplan)
+        yield from analyze_plan(subplan, analyze=analyze)
+
+def rescanned_subsets(plan, inner=False):
+    '''
+    @ret: sorted alias lists of the joins on the inner side of a Nested Loop
+    (and not below a Materialize). They run once per outer row, possibly
+    parameterized by it, so their Actual Rows are per loop averages rather
+    than the cardinality of the subset.
+    '''
+    if plan["Node Type"] == "Materialize":
+        inner = False
+    if inner and plan["Node Type"] in join_types:
+        aliases = list(sorted(extract_aliases(plan)))
+        if len(aliases) > 1:
+            yield aliases
+
+    for i, subplan in enumerate(plan.get("Plans", [])):
+        yield from rescanned_subsets(subplan, inner=inner or
+                (plan["Node Type"] == "Nested Loop" and i == 1))
 
 '''
 functions copied over from pari's util files
 '''
 
-def nodes_to_sql(nodes, join_graph):
+def nodes_to_sql(nodes, join_graph, explain=None):
     alias_mapping = {}
     for node_set in nodes:
         for node in node_set:
             alias_mapping[node] = join_graph.nodes[node]["real_name"]
 
-    from_clause = order_to_from_clause(join_graph, nodes, alias_mapping)
+    from_clause = order_to_from_clause(join_graph, nodes, alias_mapping,
+            explain=explain)
 
     subg = join_graph.subgraph(alias_mapping.keys())
     assert nx.is_connected(subg)
@@ -228,6 +270,42 @@ def nodes_to_sql(nodes, join_graph):
     sql_str = nx_graph_to_query(subg, from_clause=from_clause)
     return sql_str
 
+def tree_subsets(tree):
+    '''
+    @tree: join tree, nested pairs of aliases (see planner).
+    @ret: sorted alias tuples of every node of the join tree, leaves
+    included, children before their parents.
+    '''
+    if isinstance(tree, str):
+        yield (tree,)
+        return
+    aliases = []
+    for child in tree:
+        for subset in tree_subsets(child):
+            yield subset
+        aliases += list(subset)
+    yield tuple(sorted(aliases))
+
+def tree_to_from_clause(join_graph, tree):
+    '''
+    nested CROSS JOINs, as get_pg_join_order writes them.
+    '''
+    if isinstance(tree, str):
+        return "{} as {}".format(join_graph.nodes[tree]["real_name"], tree)
+    sides = []
+    for child in tree:
+        clause = tree_to_from_clause(join_graph, child)
+        if not isinstance(child, str):
+            clause = "(" + clause + ")"
+        sides.append(clause)
+    return " CROSS JOIN ".join(sides)
+
+def tree_to_sql(tree, join_graph):
+    aliases = list(tree_subsets(tree))[-1]
+    subg = join_graph.subgraph(aliases)
+    return nx_graph_to_query(subg,
+            from_clause=tree_to_from_clause(join_graph, tree))
+
 def nx_graph_to_query(G, from_clause=None, table_pg12=False):
     froms = []
     conds = []
@@ -263,10 +341,222 @@ def nx_graph_to_query(G, from_clause=None, table_pg12=False):
     count_query = count_query.replace(";", "")
     return count_query
 
+class CompiledQuery():
+    '''
+    the strings nx_graph_to_query / nodes_to_sql put together for a subset,
+    precomputed once per query: the FROM item of every alias, its predicates
+    and the join condition of every edge, with their positions in sorted
+    order, so that the sql of a subset (a bitmask over the sorted aliases,
+    bit i for aliases[i]) is a sort of small ints and a join. The output is
+    the same, byte for byte (see main.py --check_compiled).
+    '''
+    def __init__(self, join_graph):
+        self.join_graph = join_graph
+        self.aliases = sorted(join_graph.nodes)
+        self.index = {a: i for i, a in enumerate(self.aliases)}
+        self.bits = {a: 1 << i for i, a in enumerate(self.aliases)}
+
+        froms = []
+        for alias in self.aliases:
+            data = join_graph.nodes[alias]
+            if "real_name" in data:
+                froms.append(ALIAS_FORMAT.format(TABLE=data["real_name"],
+                    ALIAS=alias))
+            else:
+                froms.append(alias)
+        # predicates are de-duplicated by string, join conditions aren't
+        preds = sorted(set(pred for alias in self.aliases
+            for pred in join_graph.nodes[alias]["predicates"]))
+        edges = [(u, v, data["join_condition"])
+                for u, v, data in join_graph.edges(data=True)]
+        conds = sorted(set(preds) | set(cond for _, _, cond in edges))
+        cond_rank = {cond: i for i, cond in enumerate(conds)}
+        from_rank = {f: i for i, f in enumerate(sorted(set(froms)))}
+
+        # the ";" are dropped from the whole query; no separator has one
+        self.conds = [cond.replace(";", "") for cond in conds]
+        self.froms = [f.replace(";", "") for f in sorted(set(froms))]
+        self.alias_from = [from_rank[f] for f in froms]
+        self.alias_preds = [sorted(set(cond_rank[p] for p in
+            join_graph.nodes[alias]["predicates"])) for alias in self.aliases]
+        self.edges = [(self.bits[u] | self.bits[v], cond_rank[cond])
+                for u, v, cond in edges]
+        self.neighbors = [sum(self.bits[n] for n in join_graph.neighbors(a))
+                for a in self.aliases]
+        self.real_names = [join_graph.nodes[a].get("real_name") for a in
+                self.aliases]
+        self._wheres = {}
+
+    def mask(self, aliases):
+        return sum(self.bits[a] for a in aliases)
+
+    def _indices(self, mask):
+        return [i for i in range(len(self.aliases)) if mask >> i & 1]
+
+    def connected(self, mask):
+        reached = mask & -mask
+        while True:
+            frontier = reached
+            for i in self._indices(reached):
+                frontier |= self.neighbors[i] & mask
+            if frontier == reached:
+                return reached == mask
+            reached = frontier
+
+    def where_clause(self, mask):
+        '''
+        @ret: " WHERE ..." of the subset, or "" without conditions.
+        '''
+        where = self._wheres.get(mask)
+        if where is None:
+            ranks = set()
+            for i in self._indices(mask):
+                ranks.update(self.alias_preds[i])
+            ranks = list(ranks)
+            ranks += [rank for edge, rank in self.edges if edge & mask == edge]
+            ranks.sort()
+            where = ""
+            if len(ranks) > 0:
+                where = " WHERE " + " AND ".join(self.conds[r] for r in ranks)
+            self._wheres[mask] = where
+        return where
+
+    def subset_sql(self, mask):
+        '''
+        @ret: nx_graph_to_query(join_graph.subgraph(aliases of mask)).
+        '''
+        froms = sorted(self.alias_from[i] for i in self._indices(mask))
+        return "SELECT COUNT(*) FROM " + " , ".join(self.froms[f]
+                for f in froms) + self.where_clause(mask)
+
+    def path_sql(self, join_order, explain=None):
+        '''
+        @ret: nodes_to_sql(join_order, join_graph, explain).
+        '''
+        if len(join_order[0]) > 1:
+            # the first relations are ordered by postgres
+            return nodes_to_sql(join_order, self.join_graph, explain=explain)
+        clauses = []
+        mask = 0
+        for rels in join_order:
+            # as in order_to_from_clause, only the first may have several
+            assert len(rels) == 1, "can't order {} after the first".format(rels)
+            i = self.index[rels[0]]
+            clauses.append("{} as {}".format(self.real_names[i],
+                rels[0]).replace(";", ""))
+            mask |= 1 << i
+        assert self.connected(mask)
+        return "SELECT COUNT(*) FROM " + " CROSS JOIN ".join(clauses) + \
+                self.where_clause(mask)
+
+_compiled = None
+
+def compile_query(join_graph):
+    '''
+    @ret: the CompiledQuery of join_graph, built once per join graph object;
+    the join graph must not change afterwards.
+    '''
+    global _compiled
+    if _compiled is None:
+        import weakref
+        _compiled = weakref.WeakKeyDictionary()
+    compiled = _compiled.get(join_graph)
+    if compiled is None:
+        compiled = CompiledQuery(join_graph)
+        _compiled[join_graph] = compiled
+    return compiled
+
+def variants_count_sql(join_graphs, aliases):
+    '''
+    @join_graphs: variants of a query, i.e., with the same topology
+    fingerprint, but different predicates.
+    @ret: a single query over the join of aliases returning the cardinality
+    of the subset in every variant, as one COUNT(*) FILTER (WHERE ..) per
+    variant. The predicates all variants share go to the WHERE clause, along
+    with the OR of the others, so only the rows some variant keeps are
+    joined.
+    '''
+    aliases = sorted(aliases)
+    base = join_graphs[0].subgraph(aliases)
+    froms = sorted(ALIAS_FORMAT.format(TABLE=base.nodes[a]["real_name"],
+        ALIAS=a) for a in aliases)
+    conds = sorted(data["join_condition"] for _, _, data in
+            base.edges(data=True))
+
+    variant_preds = []
+    for join_graph in join_graphs:
+        preds = {}
+        for alias in aliases:
+            for pred in join_graph.nodes[alias]["predicates"]:
+                pred = pred.replace(";", "").strip()
+                preds.setdefault(normalize_clause(pred), pred)
+        variant_preds.append(preds)
+    common = set.intersection(*[set(p) for p in variant_preds])
+    conds += sorted("(" + variant_preds[0][key] + ")" for key in common)
+
+    filters = []
+    for preds in variant_preds:
+        rest = sorted("(" + pred + ")" for key, pred in preds.items()
+                if key not in common)
+        filters.append(" AND ".join(rest) if len(rest) > 0 else None)
+    if None not in filters:
+        conds.append("(" + " OR ".join("(" + f + ")" for f in filters) + ")")
+
+    counts = ", ".join("COUNT(*) FILTER (WHERE {})".format(f) if f is not None
+            else "COUNT(*)" for f in filters)
+    sql = "SELECT {} FROM {}".format(counts, " , ".join(froms))
+    if len(conds) > 0:
+        sql += " WHERE " + " AND ".join(conds)
+    return sql
+
+def materialize_join_graph(join_graph, prefix):
+    '''
+    Pushes the single table predicates of every filtered alias into a temp
+    table holding just the columns its joins need.
+
+    @prefix: name prefix of the temp tables; the table for alias a is
+    {prefix}_{a}.
+
+    @ret:
+        mat_graph: copy of join_graph where the filtered aliases point to
+        their temp tables and have no predicates left, so nodes_to_sql on it
+        gives the rewritten path queries.
+        setup_sqls: CREATE TEMP TABLE and ANALYZE statements.
+        cleanup_sqls: DROP statements.
+    '''
+    mat_graph = join_graph.copy()
+    setup_sqls = []
+    cleanup_sqls = []
+    for alias, data in join_graph.nodes(data=True):
+        preds = [p.replace(";", "").strip() for p in data["predicates"]]
+        if len(preds) == 0:
+            continue
+
+        columns = set()
+        for nbr in join_graph.neighbors(alias):
+            cond = join_graph[alias][nbr]["join_condition"]
+            for col in re.findall(r"\b{}\.(\w+)".format(re.escape(alias)), cond):
+                columns.add(col)
+        columns = ", ".join("{}.{}".format(alias, c) for c in sorted(columns))
+
+        table = "{}_{}".format(prefix, alias)
+        setup_sqls.append("CREATE TEMP TABLE {} AS SELECT {} FROM {} WHERE {}"
+                .format(table, columns,
+                    ALIAS_FORMAT.format(TABLE=data["real_name"], ALIAS=alias),
+                    " AND ".join(preds)))
+        setup_sqls.append("ANALYZE {}".format(table))
+        cleanup_sqls.append("DROP TABLE IF EXISTS {}".format(table))
+
+        mat_graph.nodes[alias]["real_name"] = table
+        mat_graph.nodes[alias]["predicates"] = []
+
+    return mat_graph, setup_sqls, cleanup_sqls
+
 def extract_join_clause(query):
     '''
     FIXME: this can be optimized further / or made to handle more cases
     '''
+    import sqlparse
     parsed = sqlparse.parse(query)[0]
     # let us go over all the where clauses
     start = time.time()
@@ -457,12 +747,13 @@ def extract_predicates(query):
     if bad_str2 in query:
         query = query.replace(bad_str2, "")
 
+    from moz_sql_parser import parse
     try:
         parsed_query = parse(query)
     except:
         print(query)
         print("moz sql parser failed to parse this!")
-        pdb.set_trace()
+        breakpoint()
     pred_vals = get_all_wheres(parsed_query)
 
     for i, pred in enumerate(pred_vals):
@@ -470,7 +761,7 @@ def extract_predicates(query):
             assert len(pred.keys()) == 1
         except:
             print(pred)
-            pdb.set_trace()
+            breakpoint()
         pred_type = list(pred.keys())[0]
         # if pred == "or" or pred == "OR":
             # continue
@@ -507,13 +798,17 @@ def extract_from_clause(query):
     # just table names
     tables = []
 
+    import sqlparse
+    from sqlparse.sql import IdentifierList, Identifier
+    from sqlparse.tokens import Keyword
+
     start = time.time()
     try:
         parsed = sqlparse.parse(query)[0]
     except Exception as e:
         print(e)
         print(query)
-        pdb.set_trace()
+        breakpoint()
 
     # let us go over all the where clauses
     from_token = None
@@ -541,6 +836,7 @@ def find_next_match(tables, wheres, index):
     '''
     ignore everything till next
     '''
+    import sqlparse
     match = ""
     _, token = wheres.token_next(index)
     if token is None:
@@ -607,6 +903,7 @@ def find_all_clauses(tables, wheres):
     return matched
 
 def find_all_tables_till_keyword(token):
+    import sqlparse
     tables = []
     # print("fattk: ", token)
     index = 0
@@ -637,6 +934,7 @@ def execute_query(sql, user, db_host, port, pwd, db_name, pre_execs):
     @pre_execs: options like set join_collapse_limit to 1 that are executed
     before the query.
     '''
+    import psycopg2 as pg
     con = pg.connect(user=user, host=db_host, port=port,
             password=pwd, database=db_name)
     cursor = con.cursor()
@@ -668,6 +966,64 @@ def execute_query(sql, user, db_host, port, pwd, db_name, pre_execs):
 def deterministic_hash(string):
     return hashlib.sha1(str(string).encode("utf-8")).hexdigest()
 
+def normalize_clause(clause):
+    '''
+    canonical spelling of a predicate or join condition: no ";", lower case
+    and single spaces outside of string literals, and single spaces around
+    comparison operators.
+    '''
+    # odd pieces are string literals, which we leave alone
+    pieces = re.split(r"('(?:[^']|'')*')", clause.replace(";", ""))
+    for i in range(0, len(pieces), 2):
+        piece = pieces[i].lower()
+        piece = re.sub(r"\s*(<=|>=|<>|!=|=|<|>)\s*", r" \1 ", piece)
+        piece = re.sub(r"\s*,\s*", ", ", piece)
+        piece = re.sub(r"\(\s+", "(", piece)
+        piece = re.sub(r"\s+\)", ")", piece)
+        pieces[i] = re.sub(r"\s+", " ", piece)
+    return "".join(pieces).strip()
+
+def normalize_join_condition(cond):
+    '''
+    like normalize_clause, and also puts the two sides of the (symmetric)
+    comparison in sorted order.
+    '''
+    cond = normalize_clause(cond)
+    for op in [" != ", " = "]:
+        if op in cond:
+            left, right = cond.split(op, 1)
+            return op.join(sorted([left.strip(), right.strip()]))
+    return cond
+
+def query_fingerprint(join_graph):
+    '''
+    Hash of the canonical form of the query: its aliases with their tables,
+    the normalized join conditions, and every alias's normalized predicates,
+    all sorted (as nx_graph_to_query sorts them). So it does not depend on
+    whitespace, a trailing semicolon, or the order of the FROM items and of
+    the AND-ed predicates.
+    '''
+    aliases, joins = _topology(join_graph)
+    preds = sorted(set("{}:{}".format(alias, normalize_clause(pred))
+            for alias, data in join_graph.nodes(data=True)
+            for pred in data["predicates"]))
+    return deterministic_hash(json.dumps([aliases, joins, preds]))
+
+def _topology(join_graph):
+    aliases = sorted("{}:{}".format(alias, data.get("real_name", alias))
+            for alias, data in join_graph.nodes(data=True))
+    joins = sorted(normalize_join_condition(data["join_condition"])
+            for _, _, data in join_graph.edges(data=True))
+    return aliases, joins
+
+def topology_fingerprint(join_graph):
+    '''
+    like query_fingerprint, but without the predicates: queries with the
+    same topology fingerprint (e.g. the variants of a template) have the same
+    subset graph.
+    '''
+    return deterministic_hash(json.dumps(list(_topology(join_graph))))
+
 def make_dir(directory):
     try:
         os.makedirs(directory)
@@ -699,7 +1055,7 @@ def get_pg_join_order(join_graph, explain):
                 from_alias = from_clause[from_clause.find(" as ")+4:]
                 if "_info" in from_alias:
                     print(from_alias)
-                    pdb.set_trace()
+                    breakpoint()
                 all_nodes.append(from_alias)
             all_nodes.sort()
             all_nodes = " ".join(all_nodes)
@@ -728,14 +1084,24 @@ def get_pg_join_order(join_graph, explain):
         return __extract_jo(explain[0][0][0]["Plan"]), physical_join_ops, scan_ops
     except:
         print(explain)
-        pdb.set_trace()
+        breakpoint()
 
-def extract_join_graph(sql):
+def extract_join_graph(sql, fast=True):
     '''
     @sql: string
+    @fast: try the conjunctive fast path parser first (see fast_parser); we
+    fall back to sqlparse if the query is outside of its fragment.
     '''
-    froms,aliases,tables = extract_from_clause(sql)
-    joins = extract_join_clause(sql)
+    predicates = None
+    if fast:
+        try:
+            froms, aliases, tables, joins, predicates = parse_conjunctive(sql)
+        except UnsupportedQuery:
+            predicates = None
+
+    if predicates is None:
+        froms,aliases,tables = extract_from_clause(sql)
+        joins = extract_join_clause(sql)
     join_graph = nx.Graph()
 
     for j in joins:
@@ -764,6 +1130,12 @@ def extract_join_graph(sql):
             join_graph.nodes()[t1]["real_name"] = table1
             join_graph.nodes()[t2]["real_name"] = table2
 
+    if predicates is not None:
+        for t1 in join_graph.nodes():
+            join_graph.nodes()[t1]["predicates"] = predicates.get(t1, [])
+        return join_graph
+
+    import sqlparse
     parsed = sqlparse.parse(sql)[0]
     # let us go over all the where clauses
     where_clauses = None
@@ -0,0 +1,92 @@
+'''
+Labels the variants of a template (e.g. 10a / 10b / 10c) together.
+
+Variants have the same aliases and join conditions, and only differ in their
+predicates, so they have the same subset graph (see topology_fingerprint).
+Instead of a path cover per variant, every subset is counted once for all
+of them, with a COUNT(*) FILTER (WHERE <variant predicates>) per variant (see
+utils.variants_count_sql), and the counts are fanned out to every variant's
+entry in the subset cache. parse_sql then finds all the subsets cached.
+'''
+import time
+
+from .utils import extract_join_graph, generate_subset_graph, \
+        query_fingerprint, topology_fingerprint
+from .subset_cache import load_subsets, merge_subsets
+from .query import get_subset_cache_name
+
+def group_variants(sqls):
+    '''
+    @ret: list of lists of indices into sqls, one per join topology, in the
+    order of their first query.
+    '''
+    groups = {}
+    for i, sql in enumerate(sqls):
+        topology = topology_fingerprint(extract_join_graph(sql))
+        groups.setdefault(topology, []).append(i)
+    return list(groups.values())
+
+def label_variants(sqls, backend, subset_cache_dir="./subset_cache/",
+        checkpoint=50, subset_cache_max_bytes=None, eviction="lru"):
+    '''
+    @sqls: variants of the same query (see group_variants).
+    @backend: ExecutionBackend the counts are executed on.
+    @checkpoint: merge the results into the cache every this many counts.
+    @subset_cache_max_bytes, eviction: size cap of the subset cache, as in
+    parse_sql, enforced at every merge.
+    @ret: number of count queries executed.
+    '''
+    join_graphs = [extract_join_graph(sql) for sql in sqls]
+    fingerprints = [query_fingerprint(g) for g in join_graphs]
+    assert len(set(topology_fingerprint(g) for g in join_graphs)) == 1, \
+            "not variants of the same query"
+    subset_graph = generate_subset_graph(join_graphs[0])
+
+    stored = [load_subsets(subset_cache_dir, get_subset_cache_name(fp), fp)
+            for fp in fingerprints]
+    # every subset is counted only in the variants that don't know it yet
+    requests = []
+    for node in subset_graph.nodes:
+        unknown = [i for i in range(len(sqls)) if node not in stored[i]]
+        if len(unknown) > 0:
+            requests.append((unknown, node))
+    print(len(requests), "/", len(subset_graph.nodes), "subsets unknown in",
+            "some of the", len(sqls), "variants")
+
+    # estimates are per variant, from the optimizer, if the backend has one
+    estimates = [{} for _ in sqls]
+    for i in range(len(sqls)):
+        missing = [node for unknown, node in requests if i in unknown]
+        for j, expected in backend.map_estimates(join_graphs[i], missing):
+            if expected is not None:
+                estimates[i][missing[j]] = expected
+
+    new = [{} for _ in sqls]
+    def _flush(cost):
+        for i, subsets in enumerate(new):
+            if len(subsets) == 0:
+                continue
+            merge_subsets(subset_cache_dir, get_subset_cache_name(
+                fingerprints[i]), fingerprints[i], subsets, cost=cost,
+                max_bytes=subset_cache_max_bytes, policy=eviction,
+                aliases=join_graphs[i].nodes)
+            subsets.clear()
+
+    start = time.time()
+    num_done = 0
+    for idx, counts in backend.map_count_variants([([join_graphs[i] for i in
+            unknown], node) for unknown, node in requests]):
+        if counts is None:
+            print("Query failed to execute, ignoring.")
+            continue
+        unknown, node = requests[idx]
+        for i, actual in zip(unknown, counts):
+            new[i][node] = {"actual": actual}
+            if node in estimates[i]:
+                new[i][node]["expected"] = estimates[i][node]
+        num_done += 1
+        if num_done % checkpoint == 0:
+            _flush(time.time() - start)
+            start = time.time()
+    _flush(time.time() - start)
+    return len(requests)
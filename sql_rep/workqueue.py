@@ -0,0 +1,309 @@
+'''
+Work queue for labeling a workload on several machines.
+
+The queue is a sqlite file; put it (and the subset cache) on a filesystem
+every worker can reach. The coordinator enqueues a corpus: every query's
+unknown subsets are planned (see planner), and every path or join tree
+becomes a task. Workers on any number of hosts claim batches of tasks of one
+query under a lease, execute them on their backend, and merge the results
+into the shared subset cache. A task whose lease expires (e.g. its worker
+crashed) is handed out again, and a task that failed max_attempts times is
+marked failed. Once all the tasks of a query are done, assemble writes the
+same output as parse_sql.
+
+    enqueue(queue_path, sqls, names)    # coordinator
+    work(queue_path, backend)           # on every worker
+    progress(queue_path)                # coordinator
+    assemble(queue_path, out_dir)       # coordinator, when done
+'''
+import json
+import os
+import socket
+import sqlite3
+import time
+
+import networkx as nx
+
+from .utils import extract_join_graph, generate_subset_graph, \
+        query_fingerprint
+from .subset_cache import load_subsets, merge_subsets
+from .planner import path_cover, bushy_cover, PLANNERS
+from .query import get_subset_cache_name
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    fingerprint TEXT PRIMARY KEY,
+    name TEXT,
+    sql TEXT,
+    cache_dir TEXT,
+    num_subsets INTEGER,
+    enqueued REAL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    fingerprint TEXT,
+    kind TEXT,
+    plan TEXT,
+    status TEXT,
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, fingerprint);
+"""
+
+# task statuses
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+def _connect(queue_path):
+    # we manage the transactions ourselves, see _claim
+    con = sqlite3.connect(queue_path, timeout=60, isolation_level=None)
+    con.executescript(SCHEMA)
+    return con
+
+def _plan_from_json(kind, plan):
+    def _tree(node):
+        if isinstance(node, str):
+            return node
+        return tuple(_tree(child) for child in node)
+
+    plan = json.loads(plan)
+    if kind == "tree":
+        return _tree(plan)
+    return [tuple(rels) for rels in plan]
+
+def enqueue(queue_path, sqls, names, subset_cache_dir="./subset_cache/",
+        planner="path"):
+    '''
+    plans the unknown subsets of every query and adds a task per path (or
+    join tree, with planner "bushy"). Queries already in the queue are
+    skipped while they have open tasks; otherwise, their subsets that are
+    still unknown (e.g. ones the join trees did not report) get path tasks.
+    @names: an identifier for each sql, used for the assembled outputs.
+    @ret: number of tasks added.
+    '''
+    assert planner in PLANNERS, "unknown planner {}".format(planner)
+    con = _connect(queue_path)
+    num_tasks = 0
+    for sql, name in zip(sqls, names):
+        join_graph = extract_join_graph(sql)
+        fingerprint = query_fingerprint(join_graph)
+        queued = con.execute("SELECT cache_dir FROM queries WHERE "
+                "fingerprint = ?", (fingerprint,)).fetchone()
+        cache_dir = subset_cache_dir
+        if queued is not None:
+            if con.execute("SELECT 1 FROM tasks WHERE fingerprint = ? AND "
+                    "status IN (?, ?)", (fingerprint, PENDING, LEASED)
+                    ).fetchone() is not None:
+                print(name, "is already queued")
+                continue
+            cache_dir = queued[0]
+
+        subset_graph = generate_subset_graph(join_graph)
+        stored = load_subsets(cache_dir, get_subset_cache_name(fingerprint),
+                fingerprint)
+        unknown = subset_graph.subgraph(subset_graph.nodes - stored.keys())
+        if len(unknown) == 0 and queued is not None:
+            continue
+        if planner == "bushy" and queued is None:
+            kind = "tree"
+            plans = bushy_cover(join_graph, unknown)
+        else:
+            kind = "order"
+            plans = path_cover(unknown)
+
+        con.execute("BEGIN IMMEDIATE")
+        if queued is None:
+            con.execute("INSERT INTO queries VALUES (?, ?, ?, ?, ?, ?)",
+                    (fingerprint, name, sql, cache_dir, len(subset_graph),
+                     time.time()))
+        con.executemany("INSERT INTO tasks (fingerprint, kind, plan, status) "
+                "VALUES (?, ?, ?, ?)", [(fingerprint, kind, json.dumps(plan),
+                    PENDING) for plan in plans])
+        con.execute("COMMIT")
+        print(name, ":", len(unknown), "unknown subsets in", len(plans), "tasks")
+        num_tasks += len(plans)
+
+    con.close()
+    return num_tasks
+
+def _claim(con, owner, lease_seconds, batch_size, max_attempts):
+    '''
+    leases up to batch_size pending (or expired) tasks of a single query.
+    @ret: list of (id, fingerprint, kind, plan) rows.
+    '''
+    now = time.time()
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        # expired leases that used up their attempts won't be retried
+        con.execute("UPDATE tasks SET status = ?, error = 'lease expired' "
+                "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (FAILED, LEASED, now, max_attempts))
+        claimable = "(status = ? OR (status = ? AND lease_expires < ?))"
+        row = con.execute("SELECT fingerprint FROM tasks WHERE " + claimable +
+                " ORDER BY id LIMIT 1", (PENDING, LEASED, now)).fetchone()
+        if row is None:
+            con.execute("COMMIT")
+            return []
+        rows = con.execute("SELECT id, fingerprint, kind, plan FROM tasks "
+                "WHERE fingerprint = ? AND " + claimable + " ORDER BY id LIMIT ?",
+                (row[0], PENDING, LEASED, now, batch_size)).fetchall()
+        con.executemany("UPDATE tasks SET status = ?, owner = ?, "
+                "lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                [(LEASED, owner, now + lease_seconds, r[0]) for r in rows])
+        con.execute("COMMIT")
+    except:
+        con.execute("ROLLBACK")
+        raise
+    return rows
+
+def work(queue_path, backend, worker_id=None, lease_seconds=3600,
+        batch_size=8, max_attempts=3, poll=0, max_tasks=None,
+        subset_cache_max_bytes=None, eviction="lru"):
+    '''
+    claims and executes tasks till the queue is empty.
+    @backend: ExecutionBackend the tasks are executed on.
+    @lease_seconds: a claimed batch that is not done by then is handed out
+    again, so it should be well above the time a batch takes.
+    @poll: if > 0, wait this many seconds for new tasks instead of stopping
+    when there are none.
+    @max_tasks: stop after this many tasks.
+    @subset_cache_max_bytes, eviction: size cap of the subset cache, as in
+    parse_sql, enforced at every merge.
+    @ret: number of tasks done.
+    '''
+    if worker_id is None:
+        worker_id = "{}:{}".format(socket.gethostname(), os.getpid())
+    con = _connect(queue_path)
+    # fingerprint -> (join graph, cache dir)
+    queries = {}
+    num_done = 0
+    while max_tasks is None or num_done < max_tasks:
+        rows = _claim(con, worker_id, lease_seconds, batch_size, max_attempts)
+        if len(rows) == 0:
+            if poll > 0:
+                time.sleep(poll)
+                continue
+            break
+
+        fingerprint = rows[0][1]
+        if fingerprint not in queries:
+            sql, cache_dir = con.execute("SELECT sql, cache_dir FROM queries "
+                    "WHERE fingerprint = ?", (fingerprint,)).fetchone()
+            queries[fingerprint] = (extract_join_graph(sql), cache_dir)
+        join_graph, cache_dir = queries[fingerprint]
+
+        orders = [r for r in rows if r[2] == "order"]
+        trees = [r for r in rows if r[2] == "tree"]
+        start = time.time()
+        results = {}
+        if len(orders) > 0:
+            for i, res in backend.map_join_orders(join_graph,
+                    [_plan_from_json(r[2], r[3]) for r in orders]):
+                results[orders[i][0]] = res
+        if len(trees) > 0:
+            for i, res in backend.map_join_trees(join_graph,
+                    [_plan_from_json(r[2], r[3]) for r in trees]):
+                results[trees[i][0]] = res
+
+        subsets = {}
+        for res in results.values():
+            for result in res or []:
+                subsets[tuple(sorted(result["aliases"]))] = {k: v for k, v in
+                        result.items() if k in ("expected", "actual")}
+        merge_subsets(cache_dir, get_subset_cache_name(fingerprint),
+                fingerprint, subsets, cost=time.time()-start,
+                max_bytes=subset_cache_max_bytes, policy=eviction,
+                aliases=join_graph.nodes)
+
+        done = [task_id for task_id, res in results.items() if res is not None]
+        failed = [task_id for task_id, res in results.items() if res is None]
+        con.execute("BEGIN IMMEDIATE")
+        con.executemany("UPDATE tasks SET status = ?, owner = NULL WHERE id = ?",
+                [(DONE, task_id) for task_id in done])
+        con.executemany("UPDATE tasks SET status = CASE WHEN attempts >= ? "
+                "THEN ? ELSE ? END, owner = NULL, error = 'query failed' "
+                "WHERE id = ?", [(max_attempts, FAILED, PENDING, task_id)
+                    for task_id in failed])
+        con.execute("COMMIT")
+        num_done += len(done)
+        print(worker_id, "finished", len(done), "tasks,", len(failed),
+              "failed, in {:.2f}s".format(time.time() - start))
+
+    con.close()
+    return num_done
+
+def progress(queue_path):
+    '''
+    @ret: dict with the number of tasks per status, overall and per query
+    name, and the workers holding live leases.
+    '''
+    con = _connect(queue_path)
+    now = time.time()
+    totals = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+    per_query = {}
+    for name, status, num in con.execute("SELECT q.name, t.status, COUNT(*) "
+            "FROM tasks t JOIN queries q ON t.fingerprint = q.fingerprint "
+            "GROUP BY q.name, t.status"):
+        totals[status] += num
+        per_query.setdefault(name, {})[status] = num
+    workers = [r[0] for r in con.execute("SELECT DISTINCT owner FROM tasks "
+        "WHERE status = ? AND lease_expires >= ?", (LEASED, now))]
+    con.close()
+    return {"tasks": totals, "queries": per_query, "workers": workers}
+
+def retry_failed(queue_path):
+    '''
+    gives the failed tasks another max_attempts.
+    @ret: number of tasks requeued.
+    '''
+    con = _connect(queue_path)
+    cur = con.execute("UPDATE tasks SET status = ?, attempts = 0, error = NULL "
+            "WHERE status = ?", (PENDING, FAILED))
+    num = cur.rowcount
+    con.close()
+    return num
+
+def assemble(queue_path, out_dir):
+    '''
+    writes <out_dir>/<name>.json, in parse_sql's output format, for every
+    query whose tasks are all done.
+    @ret: names of the queries still missing subsets.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    con = _connect(queue_path)
+    queries = con.execute("SELECT fingerprint, name, sql, cache_dir FROM "
+            "queries ORDER BY name").fetchall()
+    open_queries = set(r[0] for r in con.execute("SELECT DISTINCT fingerprint "
+        "FROM tasks WHERE status != ?", (DONE,)))
+    con.close()
+
+    incomplete = []
+    for fingerprint, name, sql, cache_dir in queries:
+        if fingerprint in open_queries:
+            incomplete.append(name)
+            continue
+        join_graph = extract_join_graph(sql)
+        subset_graph = generate_subset_graph(join_graph)
+        stored = load_subsets(cache_dir, get_subset_cache_name(fingerprint),
+                fingerprint)
+        missing = [node for node in subset_graph.nodes if node not in stored]
+        if len(missing) > 0:
+            print(name, "is missing", len(missing), "subsets")
+            incomplete.append(name)
+            continue
+
+        for node in subset_graph.nodes:
+            subset_graph.nodes[node]["cardinality"] = stored[node]
+        ret = {"sql": sql,
+               "fingerprint": fingerprint,
+               "join_graph": nx.adjacency_data(join_graph),
+               "subset_graph": nx.adjacency_data(subset_graph)}
+        with open(os.path.join(out_dir, name + ".json"), "w") as f:
+            json.dump(ret, f)
+
+    return incomplete